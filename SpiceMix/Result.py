@@ -2,9 +2,10 @@ import copy
 import h5py
 from pathlib import Path
 import pandas as pd
-from util import print_datetime, parseIiter, array2string, load_dict_from_hdf5_group, dict_to_list
+from util import print_datetime, parseIiter, array2string, load_dict_from_hdf5_group, load_history, dict_to_list
 
 import numpy as np
+import scipy.sparse
 from sklearn.metrics import calinski_harabasz_score, silhouette_score
 from sklearn.metrics.cluster import adjusted_rand_score
 
@@ -29,6 +30,7 @@ from scipy.stats import pearsonr
 # plt.rcParams['svg.fonttype'] = 'none'
 
 from load_data import load_expression
+from adjacency import Adjacency
 from model import SpiceMix
 from pathlib import Path
 
@@ -64,7 +66,9 @@ class SpiceMixResult:
         print(self.columns_exprs)
         self.columns_exprs = [" ".join(symbols) for symbols in self.columns_exprs]
         print(self.columns_exprs)
-        self.data[self.columns_exprs] = np.concatenate(self.dataset["unscaled_YTs"], axis=0)
+        self.data[self.columns_exprs] = np.concatenate([
+            YT.toarray() if scipy.sparse.issparse(YT) else YT for YT in self.dataset["unscaled_YTs"]
+        ], axis=0)
         
         if "labels" in self.dataset:
             self.dataset["labels"] = dict_to_list(self.dataset["labels"])
@@ -81,24 +85,26 @@ class SpiceMixResult:
     
     def load_progress(self):
         with h5py.File(self.result_filename, 'r') as f:
-            self.progress = load_dict_from_hdf5_group(f, 'progress/')
-            
-        self.progress["Q"] = dict_to_list(self.progress["Q"])
+            self.progress = {"Q": load_history(f, 'progress/Q')[1]}
 
     def load_parameters(self):
         with h5py.File(self.result_filename, 'r') as f:
-            self.parameters = load_dict_from_hdf5_group(f, 'parameters/')
-
-        self.parameters["sigma_x_inverse"] = dict_to_list(self.parameters["sigma_x_inverse"])
-        self.parameters["M"] = dict_to_list(self.parameters["M"])
-        self.parameters["sigma_yx_inverses"] = dict_to_list(self.parameters["sigma_yx_inverses"])
-        self.parameters["prior_x_parameter"] = dict_to_list(self.parameters["prior_x_parameter"])
+            self.parameters = {
+                "sigma_x_inverse": load_history(f, 'parameters/sigma_x_inverse')[1],
+                "M": load_history(f, 'parameters/M')[1],
+                "sigma_yx_inverses": [
+                    load_history(f, f'parameters/sigma_yx_inverses/{replicate}')[1] for replicate in sorted(f['parameters/sigma_yx_inverses'], key=int)
+                ],
+                "prior_x_parameter": [
+                    load_history(f, f'parameters/prior_x_parameter/{replicate}')[1] for replicate in sorted(f['parameters/prior_x_parameter'], key=int)
+                ],
+            }
 
     def load_dataset(self):
         with h5py.File(self.result_filename, 'r') as f:
             self.dataset = load_dict_from_hdf5_group(f, 'dataset/')
        
-        self.dataset["Es"] = {int(node): adjacency_list for node, adjacency_list in self.dataset["Es"].items()} 
+        self.dataset["Es"] = {int(replicate_index): Adjacency.from_dict(E) for replicate_index, E in self.dataset["Es"].items()}
         self.dataset["unscaled_YTs"] = dict_to_list(self.dataset["unscaled_YTs"])
         self.dataset["YTs"] = dict_to_list(self.dataset["YTs"])
         for replicate_index, replicate_name in enumerate(self.dataset["gene_sets"]):
@@ -110,7 +116,7 @@ class SpiceMixResult:
         
         self.dataset["Ns"], self.dataset["Gs"] = zip(*map(np.shape, self.dataset["unscaled_YTs"]))
         self.dataset["max_genes"] = max(self.dataset["Gs"])
-        self.dataset["total_edge_counts"] = [sum(map(len, E.values())) for E in self.dataset["Es"].values()]
+        self.dataset["total_edge_counts"] = [E.total_degree for E in self.dataset["Es"].values()]
         
         self.dataset["replicate_names"] =  [replicate_name.decode("utf-8")  for replicate_name in self.dataset["replicate_names"]]
         
@@ -122,9 +128,8 @@ class SpiceMixResult:
             
         label = kwargs.pop("label", "")
         with h5py.File(self.result_filename, 'r') as f:
-            Q_values = load_dict_from_hdf5_group(f, 'progress/Q')
-            iterations = np.fromiter(map(int, Q_values.keys()), dtype=int)
-            selected_Q_values = np.fromiter((Q_values[step][()] for step in iterations.astype(str)), dtype=float)
+            iterations, selected_Q_values = load_history(f, 'progress/Q')
+            selected_Q_values = np.array(selected_Q_values, dtype=float)
         
         Q = np.full(iterations.max() - iterations.min() + 1, np.nan)
         Q[iterations - iterations.min()] = selected_Q_values
@@ -145,9 +150,8 @@ class SpiceMixResult:
         with h5py.File(self.result_filename, 'r') as f:
             # iiter = parseIiter(f[f'latent_states/XT/{self.replicate_names[0]}'], iiter)
             print(f'Iteration {iiter}')
-            self.weights = load_dict_from_hdf5_group(f, "weights/")
-        
-        self.weights = dict_to_list(self.weights)
+            self.weights = [load_history(f, f'weights/{replicate}')[1] for replicate in sorted(f['weights'], key=int)]
+
             # XTs = [f[f'latent_states/XT/{repli}/{iiter}'][()] for repli in self.replicate_names]
         
         # XTs = [XT/ YT for XT, YT in zip(XTs, self.dataset["YTs"])]
@@ -497,7 +501,7 @@ class SpiceMixResult:
             yy = self.data.groupby('replicate').get_group(repli)[key].values
             yy = np.fromiter(map(mapping.get, yy), dtype=int)
             c += np.bincount(
-                [i * ncluster + j for i, e in zip(yy, E.values()) if i != -1 for j in yy[e] if j != -1],
+                [i * ncluster + j for i, e in zip(yy, E) if i != -1 for j in yy[e] if j != -1],
                 minlength=c.size,
             ).reshape(c.shape)
         assert (c == c.T).all(), (c - c.T)
@@ -0,0 +1,120 @@
+import numpy as np
+import scipy.sparse
+import torch
+
+class Adjacency:
+    """Neighborhood graph of a replicate in compressed sparse row (CSR) format.
+
+    The neighbors of node i are indices[indptr[i]:indptr[i+1]]. Every undirected edge is stored in both directions,
+    so len(indices) is the total degree of the graph.
+
+    Attributes:
+        indptr: int32 array of row offsets, with shape (num_nodes + 1,)
+        indices: int32 array of neighbor IDs, with shape (total_degree,)
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self._matrix = None
+
+    @classmethod
+    def empty(cls, num_nodes):
+        """Graph with num_nodes nodes and no edges."""
+
+        return cls(np.zeros(num_nodes + 1, dtype=np.int32), np.zeros(0, dtype=np.int32))
+
+    @classmethod
+    def from_adjacency_list(cls, adjacency_list):
+        """Convert a dictionary mapping each node ID (0, ..., num_nodes-1) to a list of its neighbors."""
+
+        num_nodes = len(adjacency_list)
+        degrees = np.fromiter((len(adjacency_list[node]) for node in range(num_nodes)), dtype=np.int64, count=num_nodes)
+        indptr = np.concatenate([[0], np.cumsum(degrees)])
+        indices = np.fromiter((neighbor for node in range(num_nodes) for neighbor in adjacency_list[node]), dtype=np.int32, count=indptr[-1])
+
+        return cls(indptr, indices)
+
+    @classmethod
+    def from_edges(cls, edges, num_nodes):
+        """Build the undirected graph with the given edges, with the neighbors of each node sorted by ID.
+
+        Both directions of every edge are packed into one int64 key, source * num_nodes + sink, and sorted at once,
+        so the cost is a single O(|E| log |E|) NumPy sort.
+
+        Args:
+            edges: integer array of distinct node pairs, with shape (num_edges, 2)
+            num_nodes: total number of nodes in the graph
+        """
+
+        sources = edges[:, 0].astype(np.int64)
+        sinks = edges[:, 1].astype(np.int64)
+        keys = np.concatenate([sources * num_nodes + sinks, sinks * num_nodes + sources])
+        keys.sort()
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // num_nodes, minlength=num_nodes))])
+
+        return cls(indptr, keys % num_nodes)
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        """Load a graph stored in a result file, either as CSR arrays or in the legacy one-dataset-per-node layout."""
+
+        if 'indptr' in dictionary:
+            return cls(dictionary['indptr'], dictionary['indices'])
+
+        return cls.from_adjacency_list({int(node): neighbors for node, neighbors in dictionary.items()})
+
+    def to_dict(self):
+        """Representation of the graph for :func:`util.save_dict_to_hdf5`."""
+
+        return {'indptr': self.indptr, 'indices': self.indices}
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node+1]]
+
+    def __iter__(self):
+        for start, end in zip(self.indptr[:-1], self.indptr[1:]):
+            yield self.indices[start:end]
+
+    @property
+    def degrees(self):
+        """Number of neighbors of each node."""
+
+        return np.diff(self.indptr)
+
+    @property
+    def total_degree(self):
+        """Sum of the degrees of all nodes, i.e. twice the number of edges."""
+
+        return len(self.indices)
+
+    @property
+    def matrix(self):
+        """Binary adjacency matrix as a scipy.sparse CSR matrix, built on first use."""
+
+        if self._matrix is None:
+            num_nodes = len(self)
+            self._matrix = scipy.sparse.csr_matrix((np.ones(self.total_degree), self.indices, self.indptr), shape=(num_nodes, num_nodes))
+
+        return self._matrix
+
+    def to_torch(self, dtype, device):
+        """Binary adjacency matrix as a sparse COO tensor, for neighbor sums with torch.sparse.mm."""
+
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), self.degrees)
+        indices = torch.tensor(np.stack([rows, self.indices.astype(np.int64)]), device=device)
+        values = torch.ones(self.total_degree, dtype=dtype, device=device)
+
+        return torch.sparse_coo_tensor(indices, values, (len(self), len(self))).coalesce()
+
+    def neighbor_sum(self, X):
+        """Sum the rows of X over the neighbors of each node, i.e. A @ X, with one sparse matrix product."""
+
+        return self.matrix @ X
+
+    def __getstate__(self):
+        # The scipy matrix is cheap to rebuild and would double the size of the pickle
+        return {'indptr': self.indptr, 'indices': self.indices, '_matrix': None}
@@ -0,0 +1,278 @@
+import os, queue, threading, atexit
+
+import numpy as np
+import scipy.sparse
+import h5py
+
+from util import save_dict_to_hdf5_group, load_history, get_staging_path, replace_hdf5_object, recover_hdf5_replacement, remove_staging
+
+class CheckpointWriter:
+    """Result file kept open for a whole run, storing the history of the model in extendable datasets.
+
+    Each quantity recorded over iterations, e.g. weights/<replicate> or progress/Q, is a single chunked, compressed
+    dataset whose first axis indexes checkpoints, and the iterations of those checkpoints are stored in the 1-D dataset
+    iterations/<path>. Appending a checkpoint resizes both datasets instead of creating one small dataset per
+    iteration. Entries that are written once or overwritten, e.g. the dataset and the hyperparameters, are stored with
+    :func:`util.save_dict_to_hdf5_group`. Use :func:`util.load_history` to read the history back.
+
+    Updates are grouped into :class:`CheckpointTransaction` objects. After the updates of a transaction are flushed,
+    its iteration is recorded in the committed_iteration attribute of the file, and :func:`util.load_history` ignores
+    checkpoints after the last committed iteration, so a run that is interrupted between two commits resumes from the
+    last complete checkpoint. Existing data is never deleted before its replacement is written: checkpoints are
+    appended, datasets are overwritten in place, and other objects are replaced with :func:`util.replace_hdf5_object`.
+    This is not a guarantee of crash consistency, since HDF5 does not journal its metadata; a process that is killed
+    while the library updates it may still leave the file unreadable.
+
+    Attributes:
+        filename: path to the result file
+        file: the open h5py.File
+    """
+
+    def __init__(self, filename, compression='gzip', compression_level=1, chunk_bytes=2**20):
+        """
+        Args:
+            filename: path to the result file, which is created if it does not exist
+            compression: HDF5 compression filter of the history datasets, or None
+            compression_level: level of the 'gzip' filter, where low levels are much faster on float data and
+                compress almost as well
+            chunk_bytes: approximate size of each chunk of a history dataset, in bytes
+        """
+
+        self.filename = filename
+        self.compression = compression
+        self.compression_level = compression_level if compression == 'gzip' else None
+        self.chunk_bytes = chunk_bytes
+        self.file = h5py.File(filename, 'a')
+        recover_hdf5_replacement(self.file)
+
+    def write(self, dictionary):
+        """Store a nested dictionary of arrays, overwriting existing entries (see :func:`util.save_dict_to_hdf5`)."""
+
+        save_dict_to_hdf5_group(self.file, '/', dictionary)
+
+    def append(self, dictionary, iteration, path='/'):
+        """Record every array of a nested dictionary as the checkpoint of its path at the given iteration."""
+
+        for key, item in sorted(dictionary.items()):
+            full_path = path + str(key)
+            if isinstance(item, dict):
+                self.append(item, iteration, full_path + '/')
+            else:
+                self.append_value(full_path, iteration, item)
+
+    def append_value(self, path, iteration, value):
+        """Record value as the checkpoint of path at the given iteration.
+
+        Checkpoints at or after iteration, e.g. from a run that was resumed from an earlier checkpoint, are discarded.
+        """
+
+        value = np.asarray(value)
+        path = path.strip('/')
+        iterations_path = f'iterations/{path}'
+
+        if path in self.file and isinstance(self.file[path], h5py.Group):
+            self.convert_legacy_history(path)
+
+        if path not in self.file:
+            self.create_history(path, value)
+            if iterations_path in self.file:
+                self.file[iterations_path].resize(0, axis=0)
+            else:
+                self.create_iterations(iterations_path)
+
+        dataset = self.file[path]
+        iterations = self.file[iterations_path]
+        index = np.searchsorted(iterations[()], iteration)
+        dataset.resize(index + 1, axis=0)
+        iterations.resize(index + 1, axis=0)
+        dataset[index] = value
+        iterations[index] = iteration
+
+    def create_history(self, path, value):
+        """Create the empty, extendable dataset of the checkpoints of path, each shaped like value."""
+
+        # Scalars share chunks across checkpoints, so they are not compressed: an uncompressed chunk is rewritten in
+        # place, whereas a compressed one is moved, and a torn write could then lose the checkpoints already in it
+        compression = self.compression if value.ndim > 0 else None
+
+        return self.file.create_dataset(
+            path, shape=(0, *value.shape), maxshape=(None, *value.shape), dtype=value.dtype,
+            chunks=self.get_chunk_shape(value), compression=compression,
+            compression_opts=self.compression_level if compression is not None else None, shuffle=compression is not None,
+        )
+
+    def create_iterations(self, path):
+        return self.file.create_dataset(path, shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(128,))
+
+    def convert_legacy_history(self, path):
+        """Rewrite a history stored as one dataset per iteration (see :func:`util.load_history`) as a single dataset.
+
+        The converted history is written under a temporary name, and replaces the legacy one with
+        :func:`util.replace_hdf5_object` once it is complete.
+        """
+
+        iterations, values = load_history(self.file, path)
+        if len(values) == 0:
+            del self.file[path]
+            return
+
+        staging_path = get_staging_path(path)
+        staging_iterations_path = get_staging_path(f'iterations/{path}')
+        for item_path in (staging_path, staging_iterations_path):
+            if item_path in self.file:
+                del self.file[item_path]
+
+        dataset = self.create_history(staging_path, np.asarray(values[0]))
+        dataset.resize(len(values), axis=0)
+        for index, value in enumerate(values):
+            dataset[index] = value
+        iterations_dataset = self.create_iterations(staging_iterations_path)
+        iterations_dataset.resize(len(iterations), axis=0)
+        iterations_dataset[:] = iterations
+
+        replace_hdf5_object(self.file, staging_iterations_path, f'iterations/{path}')
+        replace_hdf5_object(self.file, staging_path, path)
+        remove_staging(self.file)
+
+    def get_chunk_shape(self, value):
+        """One checkpoint per chunk, split along its first axis into chunks of about chunk_bytes.
+
+        Scalars are grouped 128 checkpoints per chunk.
+        """
+
+        if value.ndim == 0:
+            return (128,)
+
+        row_bytes = max(value[0].nbytes, 1)
+        rows = min(max(self.chunk_bytes // row_bytes, 1), value.shape[0])
+
+        return (1, *(max(size, 1) for size in (rows, *value.shape[1:])))
+
+    def commit(self, iteration=None):
+        """Flush the updates written so far to disk, and make the checkpoints up to iteration visible to readers.
+
+        The marker is only written once the data is flushed, so readers never see a checkpoint whose data was not
+        written.
+        """
+
+        self.flush()
+        if iteration is not None:
+            self.file.attrs['committed_iteration'] = iteration
+            self.flush()
+
+    def submit(self, transaction):
+        """Apply a :class:`CheckpointTransaction` immediately (see :class:`BackgroundCheckpointWriter`)."""
+
+        transaction.apply(self)
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.id.get_vfd_handle())
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def copy_arrays(item):
+    """Copy the arrays in a nested dictionary, so that the caller may modify them in place while they are written."""
+
+    if isinstance(item, dict):
+        return {key: copy_arrays(value) for key, value in item.items()}
+    if isinstance(item, np.ndarray) or scipy.sparse.issparse(item):
+        return item.copy()
+    if isinstance(item, list):
+        return list(item)
+
+    return item
+
+class CheckpointTransaction:
+    """Updates of the result file that become visible together, e.g. all the checkpoints of one iteration.
+
+    Arrays are copied when they are added unless copy is False, which is only safe for arrays that are never modified,
+    e.g. the expression matrices.
+
+    Attributes:
+        operations: list of (method name of :class:`CheckpointWriter`, arguments) in the order they were added
+        iteration: latest iteration of the checkpoints appended so far, or None
+    """
+
+    def __init__(self):
+        self.operations = []
+        self.iteration = None
+
+    def write(self, dictionary, copy=True):
+        self.operations.append(('write', (copy_arrays(dictionary) if copy else dictionary,)))
+
+    def append(self, dictionary, iteration, copy=True):
+        self.operations.append(('append', (copy_arrays(dictionary) if copy else dictionary, iteration)))
+        self.iteration = iteration if self.iteration is None else max(self.iteration, iteration)
+
+    def apply(self, writer):
+        for method, arguments in self.operations:
+            getattr(writer, method)(*arguments)
+
+        writer.commit(self.iteration)
+
+class BackgroundCheckpointWriter:
+    """Apply the transactions submitted to a :class:`CheckpointWriter` in a background thread.
+
+    h5py releases the GIL while it compresses and writes, so a checkpoint is written while the next iteration runs. At
+    most max_pending transactions wait to be written; submitting another one blocks until the oldest is done, which
+    bounds the memory held by their copies of the arrays. Pending transactions are written before the file is closed,
+    either by :meth:`close` or at interpreter exit.
+
+    If a transaction fails, the transactions after it are dropped, so the last committed checkpoint stays the latest
+    visible one, and the error is raised in the main thread by the next call.
+    """
+
+    def __init__(self, writer, max_pending=2):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.is_error_raised = False
+        self.thread = threading.Thread(target=self.run, name='CheckpointWriter', daemon=True)
+        self.thread.start()
+        # Daemon threads are stopped abruptly once the atexit handlers have run
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            transaction = self.queue.get()
+            try:
+                if transaction is None:
+                    return
+                if self.error is None:
+                    transaction.apply(self.writer)
+            except BaseException as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None and not self.is_error_raised:
+            self.is_error_raised = True
+            raise RuntimeError(f'Writing a checkpoint to {self.writer.filename} failed') from self.error
+
+    def submit(self, transaction):
+        self.raise_error()
+        self.queue.put(transaction)
+
+    def flush(self):
+        """Wait until all submitted transactions are written."""
+
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.writer.close()
+        self.raise_error()
@@ -4,91 +4,96 @@ import itertools
 import resource
 import logging
 from multiprocessing import Pool, Process
+from concurrent.futures import ThreadPoolExecutor
 
-from util import psutil_process, print_datetime, array2string
+from util import psutil_process, print_datetime, array2string, get_coefficient_table
 
 import torch
 import numpy as np
-import gurobipy as grb
 from scipy.special import loggamma
 
+try:
+    import gurobipy as grb
+except ImportError:
+    grb = None
+
+from solvers import solve_column_simplex_qp
+
 def estimate_parameters_y(self, max_iterations=10):
     """Estimate model parameters that depend on Y, assuming a fixed value X = X_t.
 
-
+    The metagene subproblem is solved either natively with :func:`solvers.solve_column_simplex_qp`, working directly
+    on the sufficient statistics XXT and YXT and warm-started from the current M, or with Gurobi as a reference,
+    depending on self.metagene_solver.
     """
     
-    def calculate_unscaled_sigma_yx_inverse(M, MTM, YT, YXT, XXT):
-        """Calculated closed-form expression for sigma_yx_inverse.
-
-        TODO: fill out docstring
-        TODO: MTM is a placeholder for now; fix later
-        """
-
-        MTM = M.T @ M
+    logging.info(f'{print_datetime()}Estimating M and sigma_yx_inverse')
 
-        sigma_yx_inverse = np.dot(YT.ravel(), YT.ravel()) - 2*np.dot(YXT.ravel(), M.ravel()) + np.dot(XXT.ravel(), MTM.ravel())
+    if self.dropout_mode != 'raw':
+        raise NotImplementedError
 
-        return sigma_yx_inverse
+    YXTs = [statistics.YXT(XT) for statistics, XT in zip(self.statistics, self.XTs)]
+    XXTs = [statistics.XXT(XT) for statistics, XT in zip(self.statistics, self.XTs)]
+    sizes = np.fromiter((np.prod(YT.shape) for YT in self.YTs), dtype=float)
 
-    logging.info(f'{print_datetime()}Estimating M and sigma_yx_inverse')
+    if self.M_constraint != 'sum2one':
+        raise NotImplementedError
 
-    YXTs = []
-    XXTs = []
-    sizes = np.fromiter(map(np.size, self.YTs), dtype=float)
-    for YT, XT in zip(self.YTs, self.XTs):
-        if self.dropout_mode == 'raw':
-            YXTs.append(YT.T @ XT)
-            XXTs.append(XT.T @ XT)
-        else:
-            raise NotImplementedError
+    if self.metagene_solver == 'gurobi':
+        if grb is None:
+            raise ImportError('The gurobi metagene solver requires gurobipy to be installed')
 
-    metagene_model = grb.Model('M')
-    metagene_model.Params.OptimalityTol=1e-4
-    metagene_model.Params.FeasibilityTol=1e-4
-    metagene_model.setParam('OutputFlag', False)
-    metagene_model.Params.Threads = 1
-    if self.M_constraint == 'sum2one':
+        metagene_model = grb.Model('M')
+        metagene_model.Params.OptimalityTol=1e-4
+        metagene_model.Params.FeasibilityTol=1e-4
+        metagene_model.setParam('OutputFlag', False)
+        metagene_model.Params.Threads = 1
         metagene_variables = metagene_model.addVars(self.max_genes, self.K, lb=0.)
         metagene_model.addConstrs((metagene_variables.sum('*', i) == 1 for i in range(self.K)))
-    else:
-        raise NotImplementedError
+    elif self.metagene_solver != 'native':
+        raise NotImplementedError(f'Metagene solver {self.metagene_solver} is not implemented')
 
     for iteration in range(max_iterations):
         # Estimating M
-        objective = 0
-        for beta, YT, sigma_yx_inverse, YXT, XXT, G, XT in zip(self.betas, self.YTs, self.sigma_yx_inverses, YXTs, XXTs, self.Gs, self.XTs):
-            # constant terms
-            if self.dropout_mode == 'raw':
-                flattened_YT = YT.ravel()
-            else:
-                raise NotImplementedError
+        if self.metagene_solver == 'native':
+            quadratic_terms = []
+            linear_term = np.zeros([self.max_genes, self.K])
+            for beta, sigma_yx_inverse, YXT, XXT, G in zip(self.betas, self.sigma_yx_inverses, YXTs, XXTs, self.Gs):
+                if self.dropout_mode == 'raw':
+                    quadratic_terms.append(beta * sigma_yx_inverse**2 * XXT + 1e-5 * np.eye(self.K))
+                    linear_term[:G] -= 2 * beta * sigma_yx_inverse**2 * YXT
+                else:
+                    raise NotImplementedError
 
-            # TODO: do we need this? This component of objective does not depend on M
-            objective += beta * sigma_yx_inverse**2 * np.dot(flattened_YT, flattened_YT)
+            M = solve_column_simplex_qp(quadratic_terms, self.Gs, linear_term, X=self.M)
+        else:
+            objective = 0
+            for beta, statistics, sigma_yx_inverse, YXT, XXT, G in zip(self.betas, self.statistics, self.sigma_yx_inverses, YXTs, XXTs, self.Gs):
+                # TODO: do we need this? This component of objective does not depend on M
+                objective += beta * sigma_yx_inverse**2 * statistics.YTY
             
-            # linear terms - Adding terms for -2 y_i (M x_i)^\top
-            factor = -2 * beta * sigma_yx_inverse**2 * YXT
-            objective += grb.quicksum([factor[i, j] * metagene_variables[i, j] for i in range(G) for j in range(self.K)])
+                # linear terms - Adding terms for -2 y_i (M x_i)^\top
+                factor = -2 * beta * sigma_yx_inverse**2 * YXT
+                objective += grb.quicksum([factor[i, j] * metagene_variables[i, j] for i in range(G) for j in range(self.K)])
             
-            # quadratic terms - Element-wise matrix multiplication (Mx_i)^\top(Mx_i)
-            if self.dropout_mode == 'raw':
-                factor = beta * sigma_yx_inverse**2 * XXT
-                factor[np.diag_indices(self.K)] += 1e-5
-                objective += grb.quicksum([factor[metagene, metagene] * metagene_variables[k, metagene] * metagene_variables[k, metagene] for k in range(G) for metagene in range(self.K)])
-                factor *= 2
-                objective += grb.quicksum([factor[metagene, j] * metagene_variables[k, metagene] * metagene_variables[k, j] for k in range(G) for metagene in range(self.K) for j in range(metagene+1, self.K)])
-            else:
-                raise NotImplementedError
+                # quadratic terms - Element-wise matrix multiplication (Mx_i)^\top(Mx_i)
+                if self.dropout_mode == 'raw':
+                    factor = beta * sigma_yx_inverse**2 * XXT
+                    factor[np.diag_indices(self.K)] += 1e-5
+                    objective += grb.quicksum([factor[metagene, metagene] * metagene_variables[k, metagene] * metagene_variables[k, metagene] for k in range(G) for metagene in range(self.K)])
+                    factor *= 2
+                    objective += grb.quicksum([factor[metagene, j] * metagene_variables[k, metagene] * metagene_variables[k, j] for k in range(G) for metagene in range(self.K) for j in range(metagene+1, self.K)])
+                else:
+                    raise NotImplementedError
         
-        # TODO: what is this for? Is it regularization on the size of M? Do we need to keep it?
-        # kk = 0
-        # if kk != 0:
-        #     objective += grb.quicksum([kk/2 * metagene_variables[k, i] * metagene_variables[k, i] for k in range(self.max_genes) for i in range(self.K)])
-
-        metagene_model.setObjective(objective, grb.GRB.MINIMIZE)
-        metagene_model.optimize()
-        M = np.array([[metagene_variables[i, j].x for j in range(self.K)] for i in range(self.max_genes)])
+            # TODO: what is this for? Is it regularization on the size of M? Do we need to keep it?
+            # kk = 0
+            # if kk != 0:
+            #     objective += grb.quicksum([kk/2 * metagene_variables[k, i] * metagene_variables[k, i] for k in range(self.max_genes) for i in range(self.K)])
+
+            metagene_model.setObjective(objective, grb.GRB.MINIMIZE)
+            metagene_model.optimize()
+            M = np.array([[metagene_variables[i, j].x for j in range(self.K)] for i in range(self.max_genes)])
         
         if self.M_constraint in ('sum2one', 'none'):
             pass
@@ -103,7 +108,7 @@ def estimate_parameters_y(self, max_iterations=10):
 
         # Estimating sigma_yx_inverses
         last_sigma_yx_inverses = np.copy(self.sigma_yx_inverses)
-        unscaled_sigma_yx_inverses = np.array([calculate_unscaled_sigma_yx_inverse(self.M[:G], None, YT, YXT, XXT) for YT, YXT, XXT, G in zip(self.YTs, YXTs, XXTs, self.Gs)])
+        unscaled_sigma_yx_inverses = np.array([statistics.squared_error(self.M[:G], XT) for statistics, XT, G in zip(self.statistics, self.XTs, self.Gs)])
 
         if self.sigma_yx_inverse_mode == 'separate':
             sigma_yx_inverses = unscaled_sigma_yx_inverses / sizes
@@ -134,11 +139,92 @@ def estimate_parameters_y(self, max_iterations=10):
 
     return Q_Y
 
+def sample_cells_stratified(Ns, weights, batch_size, generator, device='cpu'):
+    """Draw a mini-batch of cells, split across replicates in proportion to their weights.
+
+    Cells are drawn uniformly with replacement within each replicate, so that sums over the mini-batch scaled by
+    N / num_samples are unbiased estimates of the sums over all cells of the replicate.
+
+    Args:
+        Ns: number of cells of each replicate
+        weights: non-negative weight of each replicate; replicates with zero weight are not sampled
+        batch_size: total number of cells to draw
+        generator: torch.Generator used for sampling
+        device: device of the returned indices
+
+    Returns:
+        For each replicate, a tensor of cell indices, or None if the replicate is not sampled.
+    """
+
+    proportions = np.asarray(weights, dtype=float)
+    proportions /= proportions.sum()
+
+    indices = []
+    for N, proportion in zip(Ns, proportions):
+        if proportion == 0:
+            indices.append(None)
+            continue
+
+        num_samples = max(int(round(batch_size * proportion)), 1)
+        indices.append(torch.randint(N, [num_samples], generator=generator).to(device))
+
+    return indices
+
+def evaluate_log_partition(z_j_sum, sigma_x_inverse, edge_proportion, device='cpu', precomputed_log_gamma=None):
+    """Sum of log Z_i^z over the given cells, and its gradient with respect to sigma_x_inverse.
+
+    Args:
+        z_j_sum: sum of the normalized weights of the neighbors of each cell, with shape (num_cells, K)
+        sigma_x_inverse: tensor with shape (K, K)
+        edge_proportion: weight of each cell in the sum
+        device: device of the tensors
+        precomputed_log_gamma: optional table of log-gamma values for :func:`integrate_over_simplex`
+
+    Returns:
+        The weighted sum of log Z_i^z and its gradient, as tensors.
+    """
+
+    beta_i = z_j_sum @ sigma_x_inverse.detach()
+    beta_i.grad = torch.zeros_like(beta_i)
+    log_Z = integrate_over_simplex(beta_i, grad=edge_proportion, device=device, precomputed_log_gamma=precomputed_log_gamma)
+
+    return edge_proportion * log_Z.sum(), z_j_sum.t() @ beta_i.grad
+
+def map_replicates(self, function, jobs):
+    """Apply function to each per-replicate job, concurrently on self.num_replicate_threads threads if above one.
+
+    PyTorch releases the GIL inside its operators, so threads evaluate replicates in parallel. The intra-op threads
+    of PyTorch are divided among the workers for the duration of the call.
+
+    Returns:
+        List of results in the order of jobs.
+    """
+
+    num_workers = min(self.num_replicate_threads, len(jobs))
+    if num_workers <= 1:
+        return list(map(function, jobs))
+
+    if self.thread_pool is None:
+        self.thread_pool = ThreadPoolExecutor(self.num_replicate_threads)
+
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(max(num_threads // num_workers, 1))
+    try:
+        return list(self.thread_pool.map(function, jobs))
+    finally:
+        torch.set_num_threads(num_threads)
+
 def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, max_torch_iterations=1000, iterations_per_epoch=100): 
     """Estimate model parameters that depend on X, 
 
     Can operate in two modes: either using PyTorch's backward method, or using custom gradients.
 
+    Except at the beginning of each epoch, the Adam steps use a mini-batch of cells. With the 'uniform' estimator,
+    self.sigma_x_inverse_batch_size cells are drawn from each replicate. With the 'svrg' estimator, that many cells
+    are drawn in total by :func:`sample_cells_stratified`, and the gradient of the mini-batch at the snapshot taken
+    at the last full-batch step is subtracted and replaced by the full-batch gradient at that snapshot, which keeps
+    the estimate unbiased and reduces its variance as sigma_x_inverse approaches the snapshot.
+
     .. math::
                 
 
@@ -149,7 +235,7 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
     # average_metagene_expression_es = []
     sigma_x_inverse_gradient = torch.zeros([self.K, self.K], dtype=torch_dtype, device=self.device)
     z_j_sums = []
-    for YT, adjacency_list, XT, beta in zip(self.YTs, self.Es.values(), self.XTs, self.betas):
+    for replicate, (YT, XT, beta) in enumerate(zip(self.YTs, self.XTs, self.betas)):
         XT = torch.tensor(XT, dtype=torch_dtype, device=self.device)
         N, G = YT.shape
         average_metagene_expressions.append(XT.sum(axis=0))
@@ -161,9 +247,7 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
         ZT = XT / XT.sum(axis=1, keepdim=True).add(1e-30)
        
         # Each row of z_j_sum is the sum of the z_j of its neighbors
-        z_j_sum = torch.empty([N, self.K], dtype=torch_dtype, device=self.device)
-        for index, neighbor_list in adjacency_list.items():
-            z_j_sum[index] = ZT[neighbor_list].sum(axis=0)
+        z_j_sum = torch.sparse.mm(self.get_torch_adjacency(replicate, torch_dtype), ZT)
         z_j_sums.append(z_j_sum)
 
         sigma_x_inverse_gradient = sigma_x_inverse_gradient.addmm(alpha=beta, mat1=ZT.t(), mat2=z_j_sum)
@@ -177,8 +261,7 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
         # Calculating Q_X and potentially updating priors on X values
         new_prior_x_parameter_sets = []
         loggamma_K = loggamma(self.K)
-        n_cache = 2**14
-        precomputed_log_gamma = torch.tensor(loggamma(np.arange(1, n_cache)), dtype=torch_dtype, device=self.device)
+        precomputed_log_gamma = get_coefficient_table('log_gamma', dtype=torch_dtype, device=self.device)
         for num_genes, (prior_x_mode, *prior_x_parameters), average_metagene_expression in zip(self.Ns, self.prior_x_parameter_sets, average_metagene_expressions):
             if prior_x_mode == 'Exponential shared':
                 lambda_x = (average_metagene_expression.mean() / num_genes).pow(-1).cpu().data.numpy()
@@ -198,6 +281,18 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
         # Skip sigma_x_inverse estimation if not using spatial information
         if sum(self.total_edge_counts) == 0:
             return Q_X
+
+        if self.sigma_x_inverse_optimizer == 'lbfgs':
+            sigma_x_inverse, objective = estimate_sigma_x_inverse_lbfgs(self, sigma_x_inverse_gradient, z_j_sums, torch_dtype, precomputed_log_gamma)
+            self.sigma_x_inverse = sigma_x_inverse.cpu().data.numpy()
+            Q_X -= objective.item() * np.dot(self.betas, self.Ns)
+
+            return Q_X
+        elif self.sigma_x_inverse_optimizer != 'adam':
+            raise NotImplementedError(f'Optimizer for sigma_x_inverse {self.sigma_x_inverse_optimizer} is not implemented')
+
+        if self.sigma_x_inverse_estimator not in ('uniform', 'svrg') or (self.sigma_x_inverse_estimator == 'svrg' and requires_grad):
+            raise NotImplementedError(f'Estimator for sigma_x_inverse {self.sigma_x_inverse_estimator} is not implemented')
         
         # optimizers = []
         # schedulers = []
@@ -232,7 +327,7 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
         #     average_metagene_expression_e_all.add_(alpha=beta, other=average_metagene_expression_e)
         
         # total_edge_counts = [sum(map(len, E)) for E in self.Es]
-        adjacency_counts = [torch.tensor(list(map(len, E.values())), dtype=torch_dtype, device=self.device) for E in self.Es.values()]
+        adjacency_counts = [torch.tensor(E.degrees, dtype=torch_dtype, device=self.device) for E in self.Es.values()]
         # tZTs = [torch.tensor(XT, dtype=torch_dtype, device=self.device) for XT in self.XTs]
         # for tZT in tZTs:
         #     tZT.div_(tZT.sum(axis=1, keepdim=True))
@@ -249,7 +344,13 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
 
         # tZes = [None] * self.num_replicates
         
-        num_samples = 64
+        num_samples = self.sigma_x_inverse_batch_size
+
+        # Snapshot of the 'svrg' estimator, with the full-batch log partition function and gradient of each replicate
+        sigma_x_inverse_snapshot = None
+        snapshot_log_Z_sums = [None] * self.num_replicates
+        snapshot_gradients = [None] * self.num_replicates
+        stratum_weights = np.array(self.betas) * np.array(self.Ns) * (np.array(self.total_edge_counts) > 0)
 
         objective, last_objective = None, torch.empty([], dtype=torch_dtype, device=self.device).fill_(np.nan)
         best_objective, best_iteration = torch.empty([], dtype=torch_dtype, device=self.device).fill_(np.nan), -1
@@ -284,7 +385,16 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
             else:
                 objective += sigma_x_inverse_gradient.view(-1) @ sigma_x_inverse.view(-1)
 
-            for N, total_edge_count, adjacency_count, beta, z_j_sum, tprior_x in zip(self.Ns, self.total_edge_counts, adjacency_counts, self.betas, z_j_sums, tprior_x_parameter_sets):
+            use_control_variates = (self.sigma_x_inverse_estimator == 'svrg')
+            if use_control_variates and beginning_of_epoch:
+                sigma_x_inverse_snapshot = sigma_x_inverse.detach().clone()
+            elif use_control_variates:
+                sample_indices = sample_cells_stratified(self.Ns, stratum_weights, num_samples, self.generator, device=self.device)
+
+            # Select the cells of each replicate first, so that their log partition functions can be evaluated
+            # concurrently
+            jobs = []
+            for replicate, (N, total_edge_count, adjacency_count, beta, z_j_sum, tprior_x) in enumerate(zip(self.Ns, self.total_edge_counts, adjacency_counts, self.betas, z_j_sums, tprior_x_parameter_sets)):
                 
                 if total_edge_count == 0:
                     continue
@@ -292,35 +402,48 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
                 if tprior_x[0] in ('Exponential shared', 'Exponential shared fixed'):
                     if beginning_of_epoch:
                         index = slice(None)
+                    elif use_control_variates:
+                        index = sample_indices[replicate]
                     else:
                         index = np.random.choice(N, min(num_samples, N), replace=False)
 
                     z_j_sum = z_j_sum[index].contiguous()
-                    edge_proportion = total_edge_count / adjacency_count[index].sum()
-                    
-                    # Z^z(\theta)
-                    beta_i = z_j_sum @ sigma_x_inverse
-                    beta_i.grad = torch.zeros_like(beta_i)
-                    # torch.manual_seed(iteration)
-                    # TODO: delete if unncessary logic
-                    # if iteration > 1 or torch_iteration > 100:
-                    #     # log_Z = integrateOfExponentialOverSimplexSampling(beta_i, requires_grad=requires_grad, seed=iteration*max_torch_iterations+torch_iteration)
-                    #     log_Z = integrateOfExponentialOverSimplexInduction2(beta_i, grad=c, requires_grad=requires_grad, )
-                    # else:
-                    #     # log_Z = integrateOfExponentialOverSimplexSampling(beta_i, requires_grad=requires_grad, seed=iteration*max_torch_iterations+torch_iteration)
-                    #     log_Z = integrateOfExponentialOverSimplexInduction2(beta_i, grad=c, requires_grad=requires_grad)
-                    
-                    # TODO: why are we precomputing log_gamma? It seems to take no time at all.
-                    log_Z = integrate_over_simplex(beta_i, grad=edge_proportion, requires_grad=requires_grad, device=self.device, precomputed_log_gamma=precomputed_log_gamma)
-                    
-                    if requires_grad:
-                        objective_grad = objective_grad.add(beta * edge_proportion, log_Z.sum())
+                    if use_control_variates and not beginning_of_epoch:
+                        # Unbiased scaling of the mini-batch to the full replicate
+                        edge_proportion = total_edge_count / adjacency_count.sum() * N / len(index)
                     else:
-                        objective = objective.add(alpha=beta * edge_proportion, other=log_Z.sum())
-                        sigma_x_inverse.grad = sigma_x_inverse.grad.addmm(alpha=beta, mat1=z_j_sum.t(), mat2=beta_i.grad)
+                        edge_proportion = total_edge_count / adjacency_count[index].sum()
+
+                    jobs.append((replicate, beta, z_j_sum, edge_proportion))
                 else:
                     raise NotImplementedError
 
+            if requires_grad:
+                for replicate, beta, z_j_sum, edge_proportion in jobs:
+                    # Z^z(\theta)
+                    beta_i = z_j_sum @ sigma_x_inverse
+                    log_Z = integrate_over_simplex(beta_i, grad=edge_proportion, requires_grad=True, device=self.device, precomputed_log_gamma=precomputed_log_gamma)
+                    objective_grad = objective_grad.add(beta * edge_proportion, log_Z.sum())
+            else:
+                def evaluate_job(job):
+                    replicate, beta, z_j_sum, edge_proportion = job
+                    log_Z_sum, gradient = evaluate_log_partition(z_j_sum, sigma_x_inverse, edge_proportion, self.device, precomputed_log_gamma)
+                    if use_control_variates and not beginning_of_epoch:
+                        # Replace the mini-batch at the snapshot by the full batch at the snapshot
+                        snapshot_log_Z_sum, snapshot_gradient = evaluate_log_partition(z_j_sum, sigma_x_inverse_snapshot, edge_proportion, self.device, precomputed_log_gamma)
+                        log_Z_sum = log_Z_sum - snapshot_log_Z_sum + snapshot_log_Z_sums[replicate]
+                        gradient = gradient - snapshot_gradient + snapshot_gradients[replicate]
+
+                    return log_Z_sum, gradient
+
+                for (replicate, beta, *_), (log_Z_sum, gradient) in zip(jobs, map_replicates(self, evaluate_job, jobs)):
+                    if use_control_variates and beginning_of_epoch:
+                        snapshot_log_Z_sums[replicate] = log_Z_sum
+                        snapshot_gradients[replicate] = gradient
+
+                    objective = objective.add(alpha=beta, other=log_Z_sum)
+                    sigma_x_inverse.grad = sigma_x_inverse.grad.add(alpha=beta, other=gradient)
+
             if requires_grad:
                 objective_grad.backward()
                 objective = objective + objective_grad
@@ -421,9 +544,147 @@ def estimate_parameters_x(self, torch_dtype=torch.double, requires_grad=False, m
 
     return Q_X
 
-def integrate_over_simplex(beta_i, grad=None, requires_grad=False, device='cpu', precomputed_log_gamma=None):
+def estimate_sigma_x_inverse_lbfgs(self, sigma_x_inverse_gradient, z_j_sums, torch_dtype=torch.double, precomputed_log_gamma=None, max_iterations=100):
+    """Fit sigma_x_inverse by L-BFGS with a strong Wolfe line search on the full-batch objective.
+
+    This is an alternative to the Adam loop of :func:`estimate_parameters_x`, for the 'normalized' pairwise potential
+    with exponential priors. Every function evaluation uses all cells and the analytic gradient of
+    :func:`integrate_over_simplex`, so the fit usually converges in tens of evaluations.
+
+    Args:
+        sigma_x_inverse_gradient: sum over replicates of beta * ZT.T @ z_j_sum, i.e. the gradient of the pairwise term
+        z_j_sums: for each replicate, the sum of the normalized weights z_j of the neighbors of each cell
+        torch_dtype: dtype of the tensors
+        precomputed_log_gamma: optional table of log-gamma values for :func:`integrate_over_simplex`
+        max_iterations: maximum number of L-BFGS iterations
+
+    Returns:
+        The estimate of sigma_x_inverse, and the value of the objective divided by the weighted number of cells.
+    """
+
+    weighted_total_edge_count = np.dot(self.betas, self.total_edge_counts)
+    regularization_factor = self.lambda_sigma_x_inverse * weighted_total_edge_count
+    normalization = np.dot(self.betas, self.Ns)
+    adjacency_counts = [torch.tensor(E.degrees, dtype=torch_dtype, device=self.device) for E in self.Es.values()]
+
+    sigma_x_inverse = torch.tensor(self.sigma_x_inverse, dtype=torch_dtype, device=self.device)
+    optimizer = torch.optim.LBFGS(
+        [sigma_x_inverse], lr=1, max_iter=max_iterations, tolerance_grad=1e-7, tolerance_change=1e-12, history_size=10,
+        line_search_fn='strong_wolfe',
+    )
+
+    num_evaluations = 0
+
+    def closure():
+        nonlocal num_evaluations
+        num_evaluations += 1
+
+        # Same objective and gradient as the full-data evaluation in estimate_parameters_x, normalized consistently
+        objective = sigma_x_inverse_gradient.view(-1) @ sigma_x_inverse.view(-1)
+        gradient = sigma_x_inverse_gradient.clone()
+        jobs = [
+            (beta, z_j_sum, total_edge_count / adjacency_count.sum())
+            for total_edge_count, adjacency_count, beta, z_j_sum in zip(self.total_edge_counts, adjacency_counts, self.betas, z_j_sums)
+            if total_edge_count > 0
+        ]
+        def evaluate_job(job):
+            beta, z_j_sum, edge_proportion = job
+            return evaluate_log_partition(z_j_sum, sigma_x_inverse, edge_proportion, self.device, precomputed_log_gamma)
+
+        for (beta, *_), (log_Z_sum, replicate_gradient) in zip(jobs, map_replicates(self, evaluate_job, jobs)):
+            objective = objective + beta * log_Z_sum
+            gradient = gradient.add(alpha=beta, other=replicate_gradient)
+
+        objective = objective + regularization_factor / 2 * sigma_x_inverse.pow(2).sum()
+        gradient += regularization_factor * sigma_x_inverse
+
+        sigma_x_inverse.grad = (gradient + gradient.t()) / 2 / normalization
+
+        return objective / normalization
+
+    optimizer.step(closure)
+    objective = closure()
+
+    logging.info(f'{print_datetime()}L-BFGS for Σ_x^inv: objective = {objective.item():.2e} after {num_evaluations} evaluations')
+
+    return sigma_x_inverse.detach(), objective.detach()
+
+def integrate_over_simplex_by_matrix_exponential(beta_i, grad=None, requires_grad=False):
+    r"""Evaluate log Z_i^z = log \int_{\Delta} exp(-beta_i^T z) dz exactly, at a cost independent of the range of beta_i.
+
+    By the Hermite-Genocchi formula, the integral over the simplex is the divided difference of exp at the points
+    -beta_i, which by Opitz' formula is the top-right entry of exp(J), where J is upper bidiagonal with -beta_i on the
+    diagonal and ones above it. Shifting the diagonal by its maximum keeps J non-positive on the diagonal and
+    non-negative elsewhere, so that exp(J) has no cancellation and does not overflow. All cells are evaluated with
+    one batched matrix exponential, and the gradient is obtained with autograd.
+
+    Args:
+        beta_i: tensor with shape (num_cells, num_metagenes)
+        grad: weight of the gradient of log Z accumulated into beta_i.grad when requires_grad is False
+        requires_grad: if True, return a differentiable result instead of accumulating into beta_i.grad
+
+    Returns:
+        Tensor of log Z_i^z with shape (num_cells,)
+    """
+
+    num_cells, num_metagenes = beta_i.shape
+
+    # With ones above the diagonal, the top-right entry of exp(J) is about 1/((K-1)! range^(K-1)), far below the
+    # precision of the other entries, which also breaks its gradient. Scaling the superdiagonal by s multiplies that
+    # entry by s^(K-1), and s = max((K-1)/e, range) brings it close to one.
+    def calculate_log_Z(beta_i):
+        points = -beta_i
+        offset = points.max(dim=-1, keepdim=True)[0].detach()
+        scale = (offset - points.min(dim=-1, keepdim=True)[0].detach()).clamp(min=max(num_metagenes-1, 1) / np.e)
+        J = torch.diag_embed(points - offset) + torch.diag_embed(scale.expand(num_cells, num_metagenes-1), 1)
+        return torch.linalg.matrix_exp(J)[:, 0, -1].log() - (num_metagenes-1) * scale.squeeze(-1).log() + offset.squeeze(-1)
+
+    if requires_grad:
+        return calculate_log_Z(beta_i)
+
+    if grad is None:
+        grad = 1.
+
+    with torch.enable_grad():
+        beta_i_copy = beta_i.detach().requires_grad_(True)
+        log_Z = calculate_log_Z(beta_i_copy)
+        log_Z_gradient, = torch.autograd.grad(log_Z.sum(), beta_i_copy)
+
+    beta_i.grad += grad * log_Z_gradient
+
+    return log_Z.detach()
+
+def get_num_taylor_terms(largest_entry, tolerance=1e-8, max_num_terms=32):
+    """Number of Taylor terms needed by :func:`integrate_over_simplex` for cells whose shifted beta_i lie in [0, r].
+
+    The d-th term of the series is at most r^d/d! times the first one, so the remainder after T terms is at most
+    r^T/T!/(1 - r/(T+1)) relative to the integral.
+
+    Args:
+        largest_entry: largest entry r of the shifted beta_i of the cells
+        tolerance: bound on the relative error of the integral, i.e. on the absolute error of its log
+        max_num_terms: largest number of terms to consider
+
+    Returns:
+        The smallest sufficient number of terms, or max_num_terms+1 if more than max_num_terms are needed.
+    """
+
+    num_terms = np.arange(int(largest_entry) + 1, max_num_terms + 1)
+    log_remainder = num_terms * np.log(largest_entry) - loggamma(num_terms + 1) - np.log1p(-largest_entry / (num_terms + 1))
+    is_accurate = log_remainder <= np.log(tolerance)
+    if not is_accurate.any():
+        return max_num_terms + 1
+
+    return num_terms[is_accurate.argmax()]
+
+def integrate_over_simplex(beta_i, grad=None, requires_grad=False, device='cpu', precomputed_log_gamma=None, max_taylor_terms=32, tolerance=1e-8):
     """Approximate the integral of the partition function over the simplex using Taylor approximation.
 
+    Cells are sorted by the range of their beta_i and processed in chunks of 32, and each chunk is truncated to the
+    number of Taylor terms its own range needs for the given tolerance (see :func:`get_num_taylor_terms`). Since
+    this number grows linearly with the range, the cells that would need more than max_taylor_terms terms are
+    evaluated together by :func:`integrate_over_simplex_by_matrix_exponential` instead.
+
     Todo:
         Figure out how this works.
 
@@ -432,6 +693,8 @@ def integrate_over_simplex(beta_i, grad=None, requires_grad=False, device='cpu',
         grad:
         required_grad:
         device:
+        max_taylor_terms: largest number of Taylor terms before switching to the matrix exponential
+        tolerance: bound on the truncation error of the log of each integral
     
     Returns:
         An array of approximate values for the log of the Z component of the partition function (log Z_i^z(\Theta))
@@ -443,43 +706,55 @@ def integrate_over_simplex(beta_i, grad=None, requires_grad=False, device='cpu',
         grad = torch.tensor([1.], dtype=torch.double, device=device)
 
     if precomputed_log_gamma is None:
-        precomputed_log_gamma = torch.tensor(loggamma(np.arange(1, n_cache)), dtype=torch.double, device=device)
+        precomputed_log_gamma = get_coefficient_table('log_gamma', device=device)
 
     beta_i_offset = beta_i.max(axis=-1, keepdim=True)[0] + 1e-5
-    sigma_x_inverse_range = (beta_i.max() - beta_i.min()).item()
-    num_taylor_terms = int(max(sigma_x_inverse_range+10, sigma_x_inverse_range*1.1))
 
-    log_gamma = precomputed_log_gamma[num_metagenes-1: num_metagenes+num_taylor_terms-1]
+    # Grouping cells of similar range lets most chunks stop after a few terms, and leaves the cells that are too
+    # wide for the Taylor series at the end of the order
+    largest_entries = (beta_i_offset.squeeze(-1) - beta_i.min(axis=-1)[0]).detach()
+    order = largest_entries.argsort()
+    chunk_size = 32
+    taylor_chunks = []
+    for chunk in order.split(chunk_size):
+        num_taylor_terms = get_num_taylor_terms(largest_entries[chunk[-1]].item(), tolerance, max_taylor_terms)
+        if num_taylor_terms > max_taylor_terms:
+            break
+        taylor_chunks.append((chunk, num_taylor_terms))
+
+    wide_cells = order[sum(len(chunk) for chunk, _ in taylor_chunks):]
 
     if requires_grad:
-        beta_i = beta_i - beta_i_offset
-        beta_i = beta_i.neg()
-        # beta_i = beta_i.sort()[0]
-
-        f = torch.zeros([num_cells, num_metagenes], dtype=torch.double, device=device)
-        integral = torch.zeros([num_taylor_terms, num_cells], dtype=torch.double, device=device)
-
-        for degree in range(1, num_taylor_terms):
-            f = f + beta_i.log()
-            offset = f.max(-1, keepdim=True)[0]
-            f = f.sub(offset).exp().cumsum(dim=-1).log().add(offset)
-            integral[degree].copy_(f[:, -1])
-
-        integral = integral.sub(log_gamma[:, None])
-        offset = integral.max(0, keepdim=True)[0]
-        integral = integral.sub(offset).exp().sum(0).log().add(offset.squeeze(0)).sub(beta_i_offset.squeeze(-1))
-    else:
-        beta_i_grad = beta_i.grad
-        beta_i = -(beta_i - beta_i_offset)
-        beta_i.grad = beta_i_grad
+        integral = []
+        for chunk, num_taylor_terms in taylor_chunks:
+            log_gamma = precomputed_log_gamma[num_metagenes-1: num_metagenes+num_taylor_terms-1]
+            beta_i_chunk = beta_i_offset[chunk] - beta_i[chunk]
+            # beta_i_chunk = beta_i_chunk.sort()[0]
+
+            f = torch.zeros([len(chunk), num_metagenes], dtype=torch.double, device=device)
+            integral_chunk = torch.zeros([num_taylor_terms, len(chunk)], dtype=torch.double, device=device)
+
+            for degree in range(1, num_taylor_terms):
+                f = f + beta_i_chunk.log()
+                offset = f.max(-1, keepdim=True)[0]
+                f = f.sub(offset).exp().cumsum(dim=-1).log().add(offset)
+                integral_chunk[degree].copy_(f[:, -1])
 
+            integral_chunk = integral_chunk.sub(log_gamma[:, None])
+            offset = integral_chunk.max(0, keepdim=True)[0]
+            integral.append(integral_chunk.sub(offset).exp().sum(0).log().add(offset.squeeze(0)).sub(beta_i_offset[chunk].squeeze(-1)))
+
+        if len(wide_cells) > 0:
+            integral.append(integrate_over_simplex_by_matrix_exponential(beta_i[wide_cells], requires_grad=True))
+
+        integral = torch.cat(integral).index_select(0, order.argsort())
+    else:
         integral = torch.empty(num_cells, dtype=torch.double, device=device)
 
-        # Operate on chunks of 32 cells at a time
-        chunk_size = 32
-        for beta_i_chunk, beta_i_grad_chunk, integral_chunk in zip(beta_i.split(chunk_size, 0), beta_i.grad.split(chunk_size, 0), integral.split(chunk_size, 0)):
-            actual_chunk_size = len(beta_i_chunk)
-            log_beta_i_chunk = beta_i_chunk.log()
+        for chunk, num_taylor_terms in taylor_chunks:
+            log_gamma = precomputed_log_gamma[num_metagenes-1: num_metagenes+num_taylor_terms-1]
+            actual_chunk_size = len(chunk)
+            log_beta_i_chunk = (beta_i_offset[chunk] - beta_i[chunk]).log()
             taylor_terms = torch.zeros([num_taylor_terms, actual_chunk_size], dtype=torch.double, device=device)
             gradient = torch.full([num_taylor_terms, actual_chunk_size, num_metagenes], -np.inf, dtype=torch.double, device=device)
             taylor_term = torch.zeros([actual_chunk_size, num_metagenes], dtype=torch.double, device=device)
@@ -508,12 +783,16 @@ def integrate_over_simplex(beta_i, grad=None, requires_grad=False, device='cpu',
             taylor_terms -= log_gamma[:, None]
             offset = taylor_terms.max(0, keepdim=True)[0]
             taylor_terms = (taylor_terms - offset).exp()
-            integral_chunk.copy_(taylor_terms.sum(dim=0).log() + offset.squeeze(dim=0))
+            integral_chunk = taylor_terms.sum(dim=0).log() + offset.squeeze(dim=0)
+            integral[chunk] = integral_chunk - beta_i_offset[chunk].squeeze(-1)
 
             gradient -= log_gamma[:, None, None]
-            beta_i_grad_chunk -= grad * (gradient - integral_chunk[None, :, None]).exp().sum(dim=0)
+            beta_i.grad.index_add_(0, chunk, -grad * (gradient - integral_chunk[None, :, None]).exp().sum(dim=0))
 
-        integral -= beta_i_offset.squeeze(-1)
-        beta_i.neg_().add_(beta_i_offset)
+        if len(wide_cells) > 0:
+            beta_i_wide = beta_i[wide_cells].detach()
+            beta_i_wide.grad = torch.zeros_like(beta_i_wide)
+            integral[wide_cells] = integrate_over_simplex_by_matrix_exponential(beta_i_wide, grad=grad)
+            beta_i.grad.index_add_(0, wide_cells, beta_i_wide.grad)
 
     return integral
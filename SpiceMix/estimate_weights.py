@@ -1,13 +1,21 @@
 import sys, logging, time, resource, gc, os
 import multiprocessing
 from multiprocessing import Pool
-from util import print_datetime
+from util import print_datetime, greedy_coloring, load_shared_array, load_shared_expression
 
 import numpy as np
-import gurobipy as grb
 import torch
 
-def estimate_weights_no_neighbors(YT, M, XT, prior_x_parameter_set, sigma_yx_inverse, X_constraint, dropout_mode, replicate):
+try:
+    import gurobipy as grb
+except ImportError:
+    grb = None
+
+from adjacency import Adjacency
+from sufficient_statistics import SufficientStatistics
+from solvers import solve_nonnegative_qp, solve_simplex_qp
+
+def estimate_weights_no_neighbors(YT, M, XT, prior_x_parameter_set, sigma_yx_inverse, X_constraint, dropout_mode, replicate, solver='native', statistics=None):
     """Estimate weights for a single replicate in the SpiceMix model without considering neighbors.
 
     This is essentially a benchmarking convenience function, and should return similar results to running vanilla NMF.
@@ -16,15 +24,34 @@ def estimate_weights_no_neighbors(YT, M, XT, prior_x_parameter_set, sigma_yx_inv
         YT: transpose of gene expression matrix for sample, with shape (num_cells, num_genes)
         M: current estimate of metagene matrix, with shape (num_genes, num_metagenes)
         XT: transpose of metagene weights for sample, with shape
+        solver: 'gurobi' to solve one QP per cell with Gurobi, or 'native' to solve all cells at once with
+            coordinate descent (see :func:`solvers.solve_nonnegative_qp`)
+        statistics: optional cached products of YT (see :class:`sufficient_statistics.SufficientStatistics`); built
+            from YT if not given
     Returns:
-        New estimate of transposed metagene weight matrix XT.
+        New estimate of transposed metagene weight matrix XT, and solver statistics (see :func:`create_diagnostics`).
     """
 
     if dropout_mode != 'raw':
         raise NotImplemented
 
+    if statistics is None:
+        statistics = SufficientStatistics(YT)
+
     logging.info(f'{print_datetime()}Estimating weights without neighbors in repli {replicate}')
     _, num_metagenes = XT.shape
+    diagnostics = create_diagnostics()
+    start_time = time.perf_counter()
+
+    if solver == 'native':
+        updated_XT = estimate_weights_no_neighbors_batched(statistics, M, XT, prior_x_parameter_set, sigma_yx_inverse, X_constraint)
+        diagnostics['solver_time'] += time.perf_counter() - start_time
+
+        return updated_XT, diagnostics
+    elif solver != 'gurobi':
+        raise NotImplementedError(f'Weight solver {solver} is not implemented')
+    elif grb is None:
+        raise ImportError('The gurobi weight solver requires gurobipy to be installed')
 
     updated_XT = np.zeros_like(XT)
     weight_model = grb.Model('X w/o n')
@@ -40,13 +67,13 @@ def estimate_weights_no_neighbors(YT, M, XT, prior_x_parameter_set, sigma_yx_inv
     shared_objective = 0
     if dropout_mode == 'raw':
         # MTM = M.T @ M * (sigma_yx_inverse**2 / 2.)
-        MTM = (M.T @ M + 1e-6 * np.eye(num_metagenes)) * (sigma_yx_inverse ** 2 / 2.)
+        MTM = (statistics.MTM(M) + 1e-6 * np.eye(num_metagenes)) * (sigma_yx_inverse ** 2 / 2.)
         shared_objective += grb.quicksum([weight_variables[index] * MTM[index, index] * weight_variables[index] for index in range(num_metagenes)])
         MTM *= 2
         shared_objective += grb.quicksum([weight_variables[index] * MTM[index, j] * weight_variables[j] for index in range(num_metagenes) for j in range(index+1, num_metagenes)])
         
         del MTM
-        YTM = YT @ M * (-sigma_yx_inverse ** 2)
+        YTM = statistics.YTM(M) * (-sigma_yx_inverse ** 2)
     else:
         raise NotImplementedError
 
@@ -67,15 +94,300 @@ def estimate_weights_no_neighbors(YT, M, XT, prior_x_parameter_set, sigma_yx_inv
     else:
         raise NotImplementedError
 
-    for cell_index, (y, yTM) in enumerate(zip(YT, YTM)):
-        objective = shared_objective + grb.quicksum(yTM[metagene] * weight_variables[metagene] for metagene in range(num_metagenes)) + np.dot(y, y) * sigma_yx_inverse / 2.
+    for cell_index, (squared_norm, yTM) in enumerate(zip(statistics.row_squared_norms, YTM)):
+        objective = shared_objective + grb.quicksum(yTM[metagene] * weight_variables[metagene] for metagene in range(num_metagenes)) + squared_norm * sigma_yx_inverse / 2.
         weight_model.setObjective(objective, grb.GRB.MINIMIZE)
+        solver_start_time = time.perf_counter()
         weight_model.optimize()
+        diagnostics['solver_time'] += time.perf_counter() - solver_start_time
         updated_XT[cell_index] = [weight_variables[metagene].x for metagene in range(num_metagenes)]
 
+    diagnostics['build_time'] += time.perf_counter() - start_time - diagnostics['solver_time']
+
+    return updated_XT, diagnostics
+
+def estimate_weights_no_neighbors_batched(statistics, M, XT, prior_x_parameter_set, sigma_yx_inverse, X_constraint):
+    """Solve the objective of :func:`estimate_weights_no_neighbors` for all cells at once.
+
+    The objective of every cell shares the quadratic term built from MTM and the prior, and only differs in the
+    linear term built from its row of YTM, so all cells are solved together as a batched non-negative QP, warm-started
+    from the current XT. YTM and MTM are read from statistics (see :class:`sufficient_statistics.SufficientStatistics`).
+
+    Returns:
+        New estimate of transposed metagene weight matrix XT.
+    """
+
+    assert X_constraint == 'none'
+    _, num_metagenes = XT.shape
+
+    quadratic_term = (statistics.MTM(M) + 1e-6 * np.eye(num_metagenes)) * (sigma_yx_inverse ** 2 / 2.)
+    linear_term = statistics.YTM(M) * (-sigma_yx_inverse ** 2)
+
+    prior_x_mode, *prior_x_parameters = prior_x_parameter_set
+    if prior_x_mode in ('Truncated Gaussian', 'Gaussian'):
+        mu_x, sigma_x_inv = prior_x_parameters
+        assert (sigma_x_inv > 0).all()
+        quadratic_term[np.diag_indices(num_metagenes)] += sigma_x_inv ** 2 / 2
+        linear_term -= mu_x * sigma_x_inv ** 2
+    elif prior_x_mode in ('Exponential', 'Exponential shared', 'Exponential shared fixed'):
+        lambda_x, = prior_x_parameters
+        assert (lambda_x >= 0).all()
+        linear_term += lambda_x
+    else:
+        raise NotImplementedError
+
+    updated_XT = solve_nonnegative_qp(quadratic_term, linear_term, X=XT, tolerance=1e-6)
+
     return updated_XT
 
-def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse, sigma_x_inverse, X_constraint, dropout_mode, pairwise_potential_mode, replicate):
+def create_diagnostics(local_iterations=100):
+    """Create the record of solver statistics filled in by the weight estimation of one replicate.
+
+    Keys:
+        num_sweeps: number of global ICM iterations
+        local_iteration_histogram: number of cell updates that took each number of local s_i/z_i alternations
+        num_nonconverged: number of cell updates that did not converge within local_iterations
+        solver_time: wall time spent in the QP solvers for z_i (or for XT without neighbors), in seconds
+        build_time: wall time spent building the subproblems, i.e. neighbor terms, s_i updates and QP coefficients
+        evaluation_time: wall time spent evaluating the ICM objective
+    """
+
+    return {
+        'num_sweeps': 0,
+        'local_iteration_histogram': np.zeros(local_iterations + 1, dtype=np.int64),
+        'num_nonconverged': 0,
+        'solver_time': 0.,
+        'build_time': 0.,
+        'evaluation_time': 0.,
+    }
+
+def merge_diagnostics(diagnostics, other):
+    """Add the statistics in other, e.g. from a worker process, into diagnostics."""
+
+    for key, value in other.items():
+        diagnostics[key] += value
+
+def update_S_block(ZT_block, YTM_block, MTM, prior_x_parameter_set):
+    """Calculate closed form update of s_i for a block of non-neighboring cells; vectorized form of update_s_i.
+
+    Returns:
+        Updated estimates of s_i, with shape (num_cells_in_block,)
+    """
+
+    prior_x_mode, *prior_x_parameters = prior_x_parameter_set
+
+    denominator = np.einsum('ik,kl,il->i', ZT_block, MTM, ZT_block)
+    numerator = (YTM_block * ZT_block).sum(axis=1)
+    if prior_x_mode in ('Exponential', 'Exponential shared', 'Exponential shared fixed'):
+        lambda_x, = prior_x_parameters
+        numerator -= ZT_block @ lambda_x / 2
+        del lambda_x
+    else:
+        raise NotImplementedError
+
+    numerator = np.maximum(numerator, 0)
+    S_block_new = numerator / denominator
+
+    return S_block_new
+
+def update_ZT_block(S_block, YTM_block, eta_block, ZT_block, MTM, prior_x_parameter_set, MTM_largest_eigenvalue=None):
+    """Calculate update of z_i for a block of non-neighboring cells; vectorized form of update_z_i.
+
+    The objective of each cell is s_i^2 z_i^T MTM z_i + factor_i^T z_i, so all cells share the quadratic term up
+    to the scale s_i^2 and are solved together with :func:`solvers.solve_simplex_qp`.
+
+    Returns:
+        Updated estimates of z_i, with shape (num_cells_in_block, num_metagenes)
+    """
+
+    prior_x_mode, *prior_x_parameters = prior_x_parameter_set
+
+    factor = -2 * S_block[:, None] * YTM_block + eta_block
+    if prior_x_mode in ('Exponential'):
+        lambda_x, = prior_x_parameters
+        factor += lambda_x * S_block[:, None]
+        del lambda_x
+    elif prior_x_mode in ('Exponential shared', 'Exponential shared fixed'):
+        pass
+    else:
+        raise NotImplementedError
+
+    ZT_block_new = solve_simplex_qp(MTM, factor, Z=ZT_block, scale=S_block**2, largest_eigenvalue=MTM_largest_eigenvalue)
+
+    return ZT_block_new
+
+def update_cell_block(indices, neighbor_adjacency, ZT, S, YTM, MTM, sigma_x_inverse, prior_x_parameter_set, local_iterations=100, MTM_largest_eigenvalue=None,
+        diagnostics=None):
+    """Run the local s_i/z_i alternation of ICM for a block of mutually non-neighboring cells at once.
+
+    ZT and S are updated in place.
+
+    Args:
+        indices: indices of the cells to update
+        neighbor_adjacency: rows of the (sparse) adjacency matrix corresponding to indices
+        ZT: current estimate of weights divided by size factors, with shape (num_cells, num_metagenes)
+        S: current estimate of size factors, with shape (num_cells, 1)
+        YTM: precomputed YT @ M * sigma_yx_inverse**2 / 2
+        MTM: precomputed M.T @ M * sigma_yx_inverse**2 / 2
+        sigma_x_inverse: inverse of metagene affinity matrix
+        prior_x_parameter_set: set of parameters defining prior distribution on weights
+        local_iterations: maximum number of s_i/z_i alternations
+        diagnostics: optional solver statistics to update (see :func:`create_diagnostics`)
+
+    Returns:
+        Number of cells that did not converge within local_iterations.
+    """
+
+    start_time = time.perf_counter()
+    solver_time = 0.
+    num_local_iterations = np.full(len(indices), local_iterations)
+
+    S_block = S[indices, 0]
+    ZT_block = ZT[indices]
+    YTM_block = YTM[indices]
+    eta_block = (neighbor_adjacency @ ZT) @ sigma_x_inverse
+
+    active = np.arange(len(indices))
+    for local_iteration in range(local_iterations):
+        S_block_new = np.maximum(update_S_block(ZT_block[active], YTM_block[active], MTM, prior_x_parameter_set), 1e-15)
+        delta_S_block = S_block_new - S_block[active]
+        S_block[active] = S_block_new
+
+        solver_start_time = time.perf_counter()
+        ZT_block_new = update_ZT_block(S_block_new, YTM_block[active], eta_block[active], ZT_block[active], MTM, prior_x_parameter_set, MTM_largest_eigenvalue)
+        solver_time += time.perf_counter() - solver_start_time
+        delta_ZT_block = ZT_block_new - ZT_block[active]
+        ZT_block[active] = ZT_block_new
+
+        locally_converged = (np.abs(delta_S_block) / (S_block_new + 1e-15) < 1e-3) & (np.abs(delta_ZT_block).max(axis=1) < 1e-3)
+        num_local_iterations[active[locally_converged]] = local_iteration + 1
+        active = active[~locally_converged]
+        if len(active) == 0:
+            break
+
+    ZT[indices] = ZT_block
+    S[indices, 0] = S_block
+
+    if diagnostics is not None:
+        diagnostics['local_iteration_histogram'] += np.bincount(num_local_iterations, minlength=local_iterations + 1)
+        diagnostics['num_nonconverged'] += len(active)
+        diagnostics['solver_time'] += solver_time
+        diagnostics['build_time'] += time.perf_counter() - start_time - solver_time
+
+    return len(active)
+
+def update_partition(color_classes, neighbor_adjacencies, ZT, S, YTM, MTM, sigma_x_inverse, prior_x_parameter_set, local_iterations=100, MTM_largest_eigenvalue=None):
+    """Run one ICM sweep over the interior cells of one partition of a replicate.
+
+    This is the unit of work sent to a worker process when a replicate is split into partitions. All arrays are
+    local to the partition, and only interior cells (whose neighbors all lie in the same partition) are listed in
+    color_classes, so partitions can be updated concurrently.
+
+    Returns:
+        Updated ZT, S, the number of cells that did not converge, and solver statistics of the sweep.
+    """
+
+    diagnostics = create_diagnostics(local_iterations)
+    num_nonconverged = 0
+    for indices, neighbor_adjacency in zip(color_classes, neighbor_adjacencies):
+        num_nonconverged += update_cell_block(
+            indices, neighbor_adjacency, ZT, S, YTM, MTM, sigma_x_inverse, prior_x_parameter_set, local_iterations, MTM_largest_eigenvalue, diagnostics,
+        )
+
+    return ZT, S, num_nonconverged, diagnostics
+
+class ICMObjective:
+    """Evaluator of the ICM objective from cached sufficient statistics, with incremental updates.
+
+    The reconstruction term ||YT - XT @ M.T||^2 * sigma_yx_inverse**2 / 2 is expanded as
+    sum(YT**2) * sigma_yx_inverse**2 / 2 - 2 * sum_i x_i^T YTM_i + sum_i x_i^T MTM x_i, so that the N x G residual is
+    never formed, and the pairwise term sum_i z_i^T sigma_x_inverse (sum_{j in N(i)} z_j) / 2 is a single sparse
+    product. After a subset of cells changed, :meth:`update` adjusts the objective in time proportional to the
+    number of changed cells and their edges.
+
+    Args:
+        statistics: sufficient statistics of the replicate (see :class:`sufficient_statistics.SufficientStatistics`)
+        E: neighborhood graph of the replicate (see :class:`adjacency.Adjacency`)
+        YTM: precomputed YT @ M * sigma_yx_inverse**2 / 2
+        MTM: precomputed M.T @ M * sigma_yx_inverse**2 / 2
+        sigma_yx_inverse: inverse of the noise level of the gene expression
+        sigma_x_inverse: inverse of metagene affinity matrix
+        prior_x_parameter_set: set of parameters defining prior distribution on weights
+    """
+
+    def __init__(self, statistics, E, YTM, MTM, sigma_yx_inverse, sigma_x_inverse, prior_x_parameter_set):
+        prior_x_mode, *prior_x_parameters = prior_x_parameter_set
+        if prior_x_mode in ('Exponential', 'Exponential shared', 'Exponential shared fixed'):
+            self.lambda_x, = prior_x_parameters
+        else:
+            raise NotImplementedError
+
+        self.E = E
+        self.YTM = YTM
+        self.MTM = MTM
+        # Only the symmetric part of sigma_x_inverse contributes to the pairwise term
+        self.sigma_x_inverse = (sigma_x_inverse + sigma_x_inverse.T) / 2
+        self.normalization = np.prod(statistics.YT.shape)
+        self.YTY = statistics.YTY * sigma_yx_inverse**2 / 2
+
+        self.S = None
+        self.ZT = None
+        self.total = None
+
+    def cell_terms(self, S, ZT, YTM):
+        """Reconstruction and prior terms of each cell, excluding the constant sum(YT**2)."""
+
+        XT = S * ZT
+        return np.einsum('ik,kl,il->i', XT, self.MTM, XT) - 2 * (XT * YTM).sum(axis=1) + XT @ self.lambda_x
+
+    def evaluate(self, S, ZT):
+        """Evaluate the objective from scratch and cache S and ZT for later incremental updates.
+
+        Returns:
+            value of ICM objective
+        """
+
+        self.S = np.copy(S)
+        self.ZT = np.copy(ZT)
+
+        self.total = self.YTY + self.cell_terms(self.S, self.ZT, self.YTM).sum()
+        self.total += np.dot((self.ZT @ self.sigma_x_inverse).ravel(), self.E.neighbor_sum(self.ZT).ravel()) / 2
+
+        return self.value
+
+    def update(self, indices, S_block, ZT_block):
+        """Update the objective after the cells in indices changed to S_block and ZT_block.
+
+        With D the change of ZT on the changed cells C, the pairwise term changes by
+        sum_{i in C} d_i^T sigma_x_inverse ((A @ ZT)_i + (A @ D)_i / 2), where ZT holds the previous values.
+
+        Returns:
+            value of ICM objective
+        """
+
+        if len(indices) == 0:
+            return self.value
+
+        YTM_block = self.YTM[indices]
+        self.total -= self.cell_terms(self.S[indices], self.ZT[indices], YTM_block).sum()
+        self.total += self.cell_terms(S_block, ZT_block, YTM_block).sum()
+
+        delta_ZT_block = ZT_block - self.ZT[indices]
+        neighbor_adjacency = self.E.matrix[indices]
+        neighbor_sum = neighbor_adjacency @ self.ZT + neighbor_adjacency[:, indices] @ delta_ZT_block / 2
+        self.total += np.dot((delta_ZT_block @ self.sigma_x_inverse).ravel(), neighbor_sum.ravel())
+
+        self.S[indices] = S_block
+        self.ZT[indices] = ZT_block
+
+        return self.value
+
+    @property
+    def value(self):
+        return self.total / self.normalization
+
+def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse, sigma_x_inverse, X_constraint, dropout_mode, pairwise_potential_mode, replicate, solver='native', update_mode='sequential', colors=None,
+        scheduling='full', prioritize=False, change_tolerance=1e-3, partitions=None, pool=None, statistics=None):
     r"""Estimate weights for a single replicate in the SpiceMix model using the Iterated Conditional Model (ICM).
 
     Notes:
@@ -89,7 +401,7 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
 
     Args:
         YT: transpose of gene expression matrix for replicate, with shape (num_cells, num_genes)
-        E: adjacency list for neighborhood graph in this replicate
+        E: neighborhood graph of this replicate (see :class:`adjacency.Adjacency`)
         M: current estimate of metagene matrix, with shape (num_genes, num_metagenes)
         XT: transpose of weight matrix, with shape (num_cells, num_metagenes)
         prior_x_parameter_set: set of parameters defining prior distribution on weights, with structure (prior_x_mode, ∗prior_x_parameters)
@@ -98,9 +410,30 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
         X_constraint: constraint on elements of weight matrix
         dropout_mode: TODO:
         pairwise_potential_mode: TODO
+        solver: 'native' to solve the z_i subproblems with :func:`solvers.solve_simplex_qp`, or 'gurobi' to solve them
+            with Gurobi as a reference; the 'colored' update mode always uses the native solver
+        update_mode: 'sequential' to visit cells one at a time, or 'colored' to update all cells of one color class of
+            the neighborhood graph together. Cells with the same color are not neighbors, so their updates are
+            independent and are run as batched array operations.
+        colors: optional coloring of the neighborhood graph (see :func:`util.greedy_coloring`); only used when
+            update_mode is 'colored', and computed if not provided
+        scheduling: 'full' to re-optimize every cell in every global iteration, or 'dirty' to only re-optimize cells
+            that changed by more than change_tolerance in the previous global iteration, together with their neighbors
+        prioritize: if True, visit cells (or color classes) with the largest change in the previous global iteration
+            first
+        change_tolerance: threshold on the change of a cell (max |delta z_i| or relative |delta s_i|) above which it
+            and its neighbors are re-optimized when scheduling is 'dirty'
+        partitions: optional array assigning each cell to a partition of the neighborhood graph (see
+            :func:`util.partition_graph`). If provided, each sweep first updates the interior cells of all partitions
+            concurrently using pool, and then updates the boundary cells (which have a neighbor in another partition)
+            with the latest values of their neighbors. Cell updates are run in colored batches regardless of
+            update_mode.
+        pool: optional multiprocessing pool used to update partitions concurrently
+        statistics: optional cached products of YT (see :class:`sufficient_statistics.SufficientStatistics`); built
+            from YT if not provided
 
     Returns:
-        New estimate of transposed metagene weight matrix XT.
+        New estimate of transposed metagene weight matrix XT, and solver statistics (see :func:`create_diagnostics`).
     """
 
     prior_x_mode, *prior_x_parameters = prior_x_parameter_set
@@ -108,50 +441,17 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
     _, num_metagenes = M.shape
     MTM = None
     YTM = None
+    if statistics is None:
+        statistics = SufficientStatistics(YT)
     
     # Precomputing some important matrix products
     if dropout_mode == 'raw':
-        MTM = M.T @ M * sigma_yx_inverse**2 / 2
-        YTM = YT @ M * sigma_yx_inverse**2 / 2
+        MTM = statistics.MTM(M) * sigma_yx_inverse**2 / 2
+        YTM = statistics.YTM(M) * sigma_yx_inverse**2 / 2
     else:
         raise NotImplementedError
 
-    def calculate_objective(S, ZT):
-        """Calculate current value of ICM objective.
-
-        Args:
-            YT: transpose of gene expression matrix for a particular sample
-            S: a vector of total metagene expressions for each cell
-            ZT: current estimate of weights for the sample, divided by the total for each cell
-
-        Returns:
-            value of ICM objective
-        """
-        
-        objective = 0
-        difference = YT - ( S * ZT ) @ M.T
-        if dropout_mode == 'raw':
-            difference = difference.ravel()
-        else:
-            raise NotImplementedError
-
-        objective += np.dot(difference, difference) * sigma_yx_inverse**2 / 2
-        if pairwise_potential_mode == 'normalized':
-            for neighbors, z_i in zip(E.values(), ZT):
-                objective += z_i @ sigma_x_inverse @ ZT[neighbors].sum(axis=0) / 2
-        else:
-            raise NotImplementedError
-
-        if prior_x_mode in ('Exponential', 'Exponential shared', 'Exponential shared fixed'):
-            lambda_x, = prior_x_parameters
-            objective += lambda_x @ (S * ZT).sum(axis=0)
-            del lambda_x
-        else:
-            raise NotImplementedError
-
-        objective /= YT.size
-
-        return objective
+    MTM_largest_eigenvalue = np.linalg.eigvalsh(MTM)[-1]
 
     def update_s_i(z_i, yTM):
         """Calculate closed form update for s_i.
@@ -185,31 +485,24 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
 
         return s_i_new
 
-    def update_z_i(s_i, y_i, yTM, eta):
-        """Calculate update for z_i using Gurobi simplex algorithm.
+    def update_z_i(s_i, yTy, yTM, eta, z_i=None):
+        """Calculate update for z_i, using either the native simplex QP solver or Gurobi.
 
-        Assuming fixed value of s_i, update for z_i is a linear program of the following form:
+        Assuming fixed value of s_i, update for z_i is a quadratic program of the following form:
         TODO
 
         Args:
             s_i: current estimate of size factor
+            yTy: squared norm of the expression of the current cell (see :class:`sufficient_statistics.SufficientStatistics`)
             yTM: row of YTM corresponding to current cell
             eta: aggregate contribution of neighbor z_j's, weighted by affinity matrix (sigma_x_inverse)
+            z_i: current estimate of z_i, used to warm-start the native solver
 
         Returns:
             Updated estimate of z_i
 
         """
 
-        objective = 0
-
-        # Element-wise matrix multiplication (Mz_is_i)^\top(Mz_is_i)
-        factor = s_i**2 * MTM
-        objective += grb.quicksum([weight_variables[index] * factor[index, index] * weight_variables[index] for index in range(num_metagenes)])
-        factor *= 2
-        objective += grb.quicksum([weight_variables[index] * factor[index, j] * weight_variables[j] for index in range(num_metagenes) for j in range(index+1, num_metagenes)])
-       
-       
         # Adding terms for -2 y_i M z_i s_i
         factor = -2 * s_i * yTM
         # TODO: fix formula below
@@ -228,49 +521,165 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
         else:
             raise NotImplementedError
 
+        if solver == 'native':
+            solver_start_time = time.perf_counter()
+            z_i_new, = solve_simplex_qp(MTM, factor[None], Z=None if z_i is None else z_i[None], scale=np.array([s_i**2]).ravel(), largest_eigenvalue=MTM_largest_eigenvalue)
+            diagnostics['solver_time'] += time.perf_counter() - solver_start_time
+
+            return z_i_new
+
+        objective = 0
+
+        # Element-wise matrix multiplication (Mz_is_i)^\top(Mz_is_i)
+        quadratic_factor = s_i**2 * MTM
+        objective += grb.quicksum([weight_variables[index] * quadratic_factor[index, index] * weight_variables[index] for index in range(num_metagenes)])
+        quadratic_factor *= 2
+        objective += grb.quicksum([weight_variables[index] * quadratic_factor[index, j] * weight_variables[j] for index in range(num_metagenes) for j in range(index+1, num_metagenes)])
+
         objective += grb.quicksum([weight_variables[index] * factor[index] for index in range(num_metagenes)])
         # TODO: is this line necessary? Doesn't seem like z_i affects this term of the objective
-        objective += y_i @ y_i * sigma_yx_inverse**2 / 2
+        objective += yTy * sigma_yx_inverse**2 / 2
         weight_model.setObjective(objective, grb.GRB.MINIMIZE)
+        solver_start_time = time.perf_counter()
         weight_model.optimize()
+        diagnostics['solver_time'] += time.perf_counter() - solver_start_time
 
         z_i_new = np.array([weight_variables[index].x for index in range(num_metagenes)])
 
         return z_i_new
 
+    def update_color_class(indices, neighbor_adjacency):
+        """Run the local s_i/z_i alternation for all cells of one color class at once."""
+
+        num_nonconverged = update_cell_block(
+            indices, neighbor_adjacency, ZT, S, YTM, MTM, sigma_x_inverse, prior_x_parameter_set, local_iterations, MTM_largest_eigenvalue, diagnostics,
+        )
+        if num_nonconverged > 0:
+            logging.warning(f'{num_nonconverged} cells in the {replicate}-th replicate did not converge in {local_iterations} iterations')
+
     global_iterations = 100
     local_iterations = 100
-
-    weight_model = grb.Model('ICM')
-    weight_model.Params.OptimalityTol=1e-4
-    weight_model.Params.FeasibilityTol=1e-4
-    weight_model.Params.OutputFlag = False
-    weight_model.Params.Threads = 1
-    weight_model.Params.BarConvTol = 1e-6
-    weight_variables = weight_model.addVars(num_metagenes, lb=0.)
-    weight_model.addConstr(weight_variables.sum() == 1)
+    diagnostics = create_diagnostics(local_iterations)
+
+    if solver == 'gurobi':
+        if grb is None:
+            raise ImportError('The gurobi weight solver requires gurobipy to be installed')
+
+        weight_model = grb.Model('ICM')
+        weight_model.Params.OptimalityTol=1e-4
+        weight_model.Params.FeasibilityTol=1e-4
+        weight_model.Params.OutputFlag = False
+        weight_model.Params.Threads = 1
+        weight_model.Params.BarConvTol = 1e-6
+        weight_variables = weight_model.addVars(num_metagenes, lb=0.)
+        weight_model.addConstr(weight_variables.sum() == 1)
+    elif solver != 'native':
+        raise NotImplementedError(f'Weight solver {solver} is not implemented')
 
     S = XT.sum(axis=1, keepdims=True)
     ZT = XT / (S +  1e-30)
 
-    last_objective = calculate_objective(S, ZT)
+    evaluation_start_time = time.perf_counter()
+    objective = ICMObjective(statistics, E, YTM, MTM, sigma_yx_inverse, sigma_x_inverse, prior_x_parameter_set)
+    last_objective = objective.evaluate(S, ZT)
+    diagnostics['evaluation_time'] += time.perf_counter() - evaluation_start_time
     best_objective, best_iteration = last_objective, -1
 
+    if update_mode not in ('sequential', 'colored'):
+        raise NotImplementedError(f'ICM update mode {update_mode} is not implemented')
+    if scheduling not in ('full', 'dirty'):
+        raise NotImplementedError(f'ICM scheduling {scheduling} is not implemented')
+
+    adjacency = E.matrix
+
+    if partitions is not None:
+        if solver != 'native':
+            raise NotImplementedError(f'Partitioned ICM requires the native weight solver')
+        update_mode = 'partitioned'
+
+        # Boundary cells have at least one neighbor in a different partition
+        rows = np.repeat(np.arange(num_cells), np.diff(adjacency.indptr))
+        crossing = partitions[rows] != partitions[adjacency.indices]
+        is_boundary = np.bincount(rows[crossing], minlength=num_cells) > 0
+        del rows, crossing
+
+        partition_cells = [np.flatnonzero(partitions == partition) for partition in np.unique(partitions)]
+        partition_adjacencies = [adjacency[cells][:, cells] for cells in partition_cells]
+
+    if update_mode in ('colored', 'partitioned'):
+        if colors is None:
+            colors = greedy_coloring(E)
+
+        color_classes = [np.flatnonzero(colors == color) for color in range(colors.max() + 1)]
+        neighbor_adjacencies = [adjacency[indices] for indices in color_classes]
+
+    # Cells to re-optimize in the next global iteration, and how much each cell changed in the last one
+    dirty = np.ones(num_cells, dtype=bool)
+    changes = np.full(num_cells, np.inf)
+
     for global_iteration in range(global_iterations):
         last_ZT = np.copy(ZT)
         last_S = np.copy(S)
 
-        locally_converged = False
-        if pairwise_potential_mode == 'normalized':
-            for index, (neighbors, y_i, yTM, z_i, s_i) in enumerate(zip(E.values(), YT, YTM, ZT, S)):
+        if pairwise_potential_mode == 'normalized' and update_mode == 'partitioned':
+            partition_results = []
+            for cells, partition_adjacency in zip(partition_cells, partition_adjacencies):
+                interior = np.flatnonzero(~is_boundary[cells] & dirty[cells])
+                interior_colors = colors[cells[interior]]
+                interior_color_classes = [interior[interior_colors == color] for color in np.unique(interior_colors)]
+                interior_neighbor_adjacencies = [partition_adjacency[indices] for indices in interior_color_classes]
+                args = (
+                    interior_color_classes, interior_neighbor_adjacencies, ZT[cells], S[cells], YTM[cells], MTM,
+                    sigma_x_inverse, prior_x_parameter_set, local_iterations, MTM_largest_eigenvalue,
+                )
+                partition_results.append(update_partition(*args) if pool is None else pool.apply_async(update_partition, args=args))
+
+            for cells, partition_result in zip(partition_cells, partition_results):
+                if pool is not None:
+                    partition_result = partition_result.get(1e9)
+                ZT[cells], S[cells], num_nonconverged, partition_diagnostics = partition_result
+                merge_diagnostics(diagnostics, partition_diagnostics)
+                if num_nonconverged > 0:
+                    logging.warning(f'{num_nonconverged} cells in the {replicate}-th replicate did not converge in {local_iterations} iterations')
+
+            # Boundary cells are updated after the interiors, so they see the latest values of all their neighbors
+            for indices, neighbor_adjacency in zip(color_classes, neighbor_adjacencies):
+                is_selected = is_boundary[indices] & dirty[indices]
+                if is_selected.any():
+                    update_color_class(indices[is_selected], neighbor_adjacency[is_selected])
+        elif pairwise_potential_mode == 'normalized' and update_mode == 'colored':
+            color_order = range(len(color_classes))
+            if prioritize:
+                color_order = sorted(color_order, key=lambda color: -changes[color_classes[color]][dirty[color_classes[color]]].sum(initial=0))
+
+            for color in color_order:
+                indices, neighbor_adjacency = color_classes[color], neighbor_adjacencies[color]
+                if scheduling == 'dirty':
+                    is_dirty = dirty[indices]
+                    if not is_dirty.any():
+                        continue
+                    indices, neighbor_adjacency = indices[is_dirty], neighbor_adjacency[is_dirty]
+
+                update_color_class(indices, neighbor_adjacency)
+        elif pairwise_potential_mode == 'normalized':
+            cell_order = np.arange(num_cells) if scheduling == 'full' else np.flatnonzero(dirty)
+            if prioritize:
+                cell_order = cell_order[np.argsort(-changes[cell_order], kind='stable')]
+
+            for index in cell_order:
+                cell_start_time = time.perf_counter()
+                cell_solver_time = diagnostics['solver_time']
+                # The row norm is cached, since indexing a row of a sparse or out-of-core YT is slow
+                neighbors, yTy, yTM, z_i, s_i = E[index], statistics.row_squared_norms[index], YTM[index], ZT[index], S[index]
                 eta = ZT[neighbors].sum(axis=0) @ sigma_x_inverse
+                locally_converged = False
                 for local_iteration in range(local_iterations):
                     s_i_new = update_s_i(z_i, yTM) 
                     s_i_new = np.maximum(s_i_new, 1e-15)
                     delta_s_i = s_i_new - s_i
                     s_i = s_i_new
 
-                    z_i_new = update_z_i(s_i, y_i, yTM, eta)
+                    z_i_new = update_z_i(s_i, yTy, yTM, eta, z_i)
                     delta_z_i = z_i_new - z_i
                     z_i = z_i_new
                     
@@ -278,11 +687,16 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
                     if locally_converged:
                         break
 
-                if not locally_converged:
-                    logging.warning(f'Cell {i} in the {replicate}-th replicate did not converge in {local_iterations} iterations;\ts = {s:.2e}, delta_s_i = {delta_s_i:.2e}, max delta_z_i = {np.abs(delta_z_i).max():.2e}')
+                if locally_converged:
+                    diagnostics['local_iteration_histogram'][local_iteration + 1] += 1
+                else:
+                    diagnostics['local_iteration_histogram'][local_iterations] += 1
+                    diagnostics['num_nonconverged'] += 1
+                    logging.warning(f'Cell {index} in the {replicate}-th replicate did not converge in {local_iterations} iterations;\ts = {float(s_i):.2e}, delta_s_i = {float(delta_s_i):.2e}, max delta_z_i = {np.abs(delta_z_i).max():.2e}')
 
                 ZT[index] = z_i
                 S[index] = s_i
+                diagnostics['build_time'] += time.perf_counter() - cell_start_time - (diagnostics['solver_time'] - cell_solver_time)
         else:
             raise NotImplementedError
 
@@ -290,9 +704,19 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
 
         dZT = ZT - last_ZT
         dS = S - last_S
-        current_objective = calculate_objective(S, ZT)
+        evaluation_start_time = time.perf_counter()
+        changed_cells = np.flatnonzero((dZT != 0).any(axis=1) | (dS[:, 0] != 0))
+        current_objective = objective.update(changed_cells, S[changed_cells], ZT[changed_cells])
+        diagnostics['evaluation_time'] += time.perf_counter() - evaluation_start_time
+        diagnostics['num_sweeps'] += 1
+
+        changes = np.maximum(np.abs(dZT).max(axis=1), np.abs(dS[:, 0]) / (S[:, 0] + 1e-15))
+        if scheduling == 'dirty':
+            changed = changes > change_tolerance
+            dirty = changed | (adjacency @ changed.astype(float) > 0)
 
         globally_converged |= (np.abs(dZT).max() < 1e-2 and np.abs(dS / (S + 1e-15)).max() < 1e-2 and current_objective > last_objective - 1e-4) 
+        globally_converged |= (scheduling == 'dirty' and not dirty.any())
 
         # TODO: do we need to keep this?
         force_show_flag = False
@@ -329,9 +753,47 @@ def estimate_weights_icm(YT, E, M, XT, prior_x_parameter_set, sigma_yx_inverse,
         if globally_converged:
             break
 
-    del weight_model
+    if solver == 'gurobi':
+        del weight_model
 
     # Enforce positivity constraint on S
     XT = np.maximum(S, 1e-15) * ZT
     
-    return XT
+    return XT, diagnostics
+
+# Neighborhood graphs and expression statistics opened by worker processes from shared arrays, cached across EM
+# iterations
+_shared_adjacencies = {}
+_shared_statistics = {}
+
+def estimate_weights_shared(YT_path, adjacency_paths, *args, **kwargs):
+    """Run weight estimation for one replicate in a persistent worker, reading the expression matrix and the
+    neighborhood graph from arrays shared with :func:`util.share_array`.
+
+    Only the small, changing parameters (M, XT, sigma_x_inverse, priors, ...) are pickled for each call.
+
+    Args:
+        YT_path: handle of the shared expression matrix of the replicate (see :func:`util.share_expression`)
+        adjacency_paths: paths to the shared (indptr, indices) arrays of the neighborhood graph, or None for
+            replicates without spatial edges
+        args, kwargs: remaining arguments of :func:`estimate_weights_icm`, or of
+            :func:`estimate_weights_no_neighbors` if adjacency_paths is None
+
+    Returns:
+        New estimate of transposed metagene weight matrix XT, and solver statistics (see :func:`create_diagnostics`).
+    """
+
+    if YT_path not in _shared_statistics:
+        _shared_statistics[YT_path] = SufficientStatistics(load_shared_expression(YT_path))
+    statistics = _shared_statistics[YT_path]
+    YT = statistics.YT
+
+    if adjacency_paths is None:
+        return estimate_weights_no_neighbors(YT, *args, statistics=statistics, **kwargs)
+
+    indptr_path, indices_path = adjacency_paths
+    if indices_path not in _shared_adjacencies:
+        _shared_adjacencies[indices_path] = Adjacency(load_shared_array(indptr_path), load_shared_array(indices_path))
+    E = _shared_adjacencies[indices_path]
+
+    return estimate_weights_icm(YT, E, *args, statistics=statistics, **kwargs)
@@ -3,20 +3,31 @@ from multiprocessing import Pool
 from util import print_datetime
 
 import numpy as np
-from sklearn.cluster import KMeans
-import gurobipy as grb
+import scipy.sparse
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
-def nmf_update(YT, M, XT, X_constraint, dropout_mode):
+from sufficient_statistics import get_chunk_size, iterate_row_chunks
+from solvers import solve_nonnegative_qp, solve_column_simplex_qp
+
+try:
+    import gurobipy as grb
+except ImportError:
+    grb = None
+
+def nmf_update(YTM, M, XT, X_constraint, dropout_mode, solver='native'):
     """Perform one step of the NMF optimization to update the metagene weights XT.
    
     Uses linear programming formulation to find sparse solution to NMF factorization.
 
     Args:
-        YT: transpose of gene expression matrix for a single replicate
+        YTM: product of the transposed gene expression matrix of a single replicate with M, so that the expression
+            matrix itself, which may be out-of-core, is not sent to worker processes
         M: current metagene matrix
         XT: transpose of metagene weight matrix for a single replicate
         X_constraint: constraint on metagene weight parameters
         dropout_mode: TODO
+        solver: 'gurobi' to solve one QP per cell with Gurobi, or 'native' to solve all cells at once with
+            coordinate descent (see :func:`solvers.solve_nonnegative_qp`)
 
     Returns:
         Updated estimate of XT 
@@ -25,8 +36,20 @@ def nmf_update(YT, M, XT, X_constraint, dropout_mode):
     if dropout_mode != 'raw':
         raise NotImplementedError(f'Dropout mode {dropout_mode} is not implemented')
 
-    _, num_genes = YT.shape
-    _, num_metagenes  = M.shape
+    num_genes, num_metagenes = M.shape
+
+    if solver == 'native':
+        if X_constraint != 'none':
+            raise NotImplementedError(f'Constraint on X {X_constraint} is not implemented')
+
+        # The constant y^T y of the squared error does not affect the solution and is left out
+        MTM = M.T @ M + 1e-5*np.eye(num_metagenes)
+        return solve_nonnegative_qp(MTM, -2 * YTM, X=XT)
+    elif solver != 'gurobi':
+        raise NotImplementedError(f'Weight solver {solver} is not implemented')
+
+    if grb is None:
+        raise ImportError('The gurobi weight solver requires gurobipy to be installed')
 
     weight_model = grb.Model('init_X')
     weight_model.setParam('OutputFlag', False)
@@ -41,15 +64,16 @@ def nmf_update(YT, M, XT, X_constraint, dropout_mode):
         raise NotImplementedError(f'Constraint on X {X_constraint} is not implemented')
 
     shared_objective = 0
-    MTM = M[:num_genes].T @ M[:num_genes] + 1e-5*np.eye(num_metagenes)
+    MTM = M.T @ M + 1e-5*np.eye(num_metagenes)
     shared_objective += grb.quicksum([MTM[i, j] * weight_variables[i] * weight_variables[j] for i in range(num_metagenes) for j in range(num_metagenes)])  # quadratic term of X and M
     del MTM
-    YTM = YT @ M[:num_genes] * -2
+    YTM = YTM * -2
 
     updated_XT = XT
-    for cell_index, (y, yTM) in enumerate(zip(YT, YTM)):
+    for cell_index, yTM in enumerate(YTM):
+        # The constant y^T y of the squared error does not affect the solution and is left out
         objective = shared_objective
-        objective = (objective + grb.quicksum([yTM[i] * weight_variables[i] for i in range(num_metagenes)])) + np.dot(y, y)
+        objective = objective + grb.quicksum([yTM[i] * weight_variables[i] for i in range(num_metagenes)])
         weight_model.setObjective(objective, grb.GRB.MINIMIZE)
         weight_model.optimize()
         updated_XT[cell_index] = np.fromiter((weight_variables[i].x for i in range(num_metagenes)), dtype=float)
@@ -72,11 +96,10 @@ def partial_nmf(model, prior_x_modes, initial_nmf_iterations, lambda_x=1, num_pr
     model.XTs = [np.zeros([N, model.K], dtype=float) for N in model.Ns]
 
     print("Setting sigma_yx_inverses")
-    model.sigma_yx_inverses = [1 / gene_expression.std(axis=0).mean() for gene_expression in model.YTs]
+    model.sigma_yx_inverses = [1 / statistics.column_std.mean() for statistics in model.statistics]
     model.prior_x_parameter_sets = []
-    for prior_x_mode, gene_expression in zip(prior_x_modes, model.YTs):
-        _, num_genes = gene_expression.shape
-        total_gene_expression = gene_expression.sum(axis=1)
+    for prior_x_mode, statistics in zip(prior_x_modes, model.statistics):
+        total_gene_expression = statistics.row_sums
         if prior_x_mode == 'Truncated Gaussian' or prior_x_mode == 'Gaussian':
             mu_x = np.full(model.K, total_gene_expression.mean() / model.K)
             sigma_x_inverse = np.full(model.K, np.sqrt(model.K) / total_gene_expression.std())
@@ -87,17 +110,24 @@ def partial_nmf(model, prior_x_modes, initial_nmf_iterations, lambda_x=1, num_pr
         else:
             raise NotImplementedError(f'Prior on X {prior_x_mode} is not implemented')
 
-    metagene_model = grb.Model('init_M')
-    metagene_model.setParam('OutputFlag', False)
-    metagene_model.setParam('Threads', 1)
-    if model.M_constraint == 'sum2one':
-        metagene_parameters = metagene_model.addVars(model.max_genes, model.K, lb=0.)
-        metagene_model.addConstrs((metagene_parameters.sum('*', i) == 1 for i in range(model.K)))
-    elif model.M_constraint == 'nonnegative':
-        metagene_parameters = metagene_model.addVars(model.K, lb=0.)
-    else:
+    if model.M_constraint not in ('sum2one', 'nonnegative'):
         raise NotImplementedError(f'Constraint on M {model.M_constraint} is not implemented')
 
+    if model.metagene_solver == 'gurobi':
+        if grb is None:
+            raise ImportError('The gurobi metagene solver requires gurobipy to be installed')
+
+        metagene_model = grb.Model('init_M')
+        metagene_model.setParam('OutputFlag', False)
+        metagene_model.setParam('Threads', 1)
+        if model.M_constraint == 'sum2one':
+            metagene_parameters = metagene_model.addVars(model.max_genes, model.K, lb=0.)
+            metagene_model.addConstrs((metagene_parameters.sum('*', i) == 1 for i in range(model.K)))
+        else:
+            metagene_parameters = metagene_model.addVars(model.K, lb=0.)
+    elif model.metagene_solver != 'native':
+        raise NotImplementedError(f'Metagene solver {model.metagene_solver} is not implemented')
+
     iteration = 0
     last_M = np.copy(model.M)
     last_rmse = np.nan
@@ -105,10 +135,13 @@ def partial_nmf(model, prior_x_modes, initial_nmf_iterations, lambda_x=1, num_pr
     for iteration in range(initial_nmf_iterations):
         print("Initial nmf iteration %d" % iteration)
         # update XT
+        model.flush_checkpoint_writer()
         with Pool(min(num_processes, len(model.YTs))) as pool:
             model.XTs = pool.starmap(nmf_update, zip(
-                model.YTs, [model.M]*model.num_replicates, model.XTs,
+                [statistics.YTM(model.M[:num_genes]) for statistics, num_genes in zip(model.statistics, model.Gs)],
+                [model.M[:num_genes] for num_genes in model.Gs], model.XTs,
                 [model.X_constraint]*model.num_replicates, [model.dropout_mode]*model.num_replicates,
+                [model.weight_solver]*model.num_replicates,
             ))
         pool.close()
         pool.join()
@@ -152,14 +185,12 @@ def partial_nmf(model, prior_x_modes, initial_nmf_iterations, lambda_x=1, num_pr
             raise NotImplementedError(f'Prior on X Exponential shared is not implemented')
 
         # update sigma_yx_inv
-        squared_differences = [gene_expression - weights @ model.M[:num_genes].T for gene_expression, weights, num_genes in zip(model.YTs, model.XTs, model.Gs)]
         if model.dropout_mode == 'raw':
-            squared_unraveled_differences = [squared_difference.ravel() for squared_difference in squared_differences]
-            sizes = np.fromiter(map(np.size, model.YTs), dtype=float)
+            sizes = np.fromiter((np.prod(YT.shape) for YT in model.YTs), dtype=float)
         else:
             raise NotImplementedError(f'Dropout mode {model.dropout_mode} is not implemented')
         
-        nmf_objective_values = np.fromiter((np.dot(squared_unraveled_difference, squared_unraveled_difference) for squared_unraveled_difference in squared_unraveled_differences), dtype=float)
+        nmf_objective_values = np.fromiter((statistics.squared_error(model.M[:num_genes], XT) for statistics, XT, num_genes in zip(model.statistics, model.XTs, model.Gs)), dtype=float)
 
         if model.sigma_yx_inverse_mode == 'separate':
             sigma_yx_inverses = nmf_objective_values / sizes
@@ -179,20 +210,34 @@ def partial_nmf(model, prior_x_modes, initial_nmf_iterations, lambda_x=1, num_pr
 
         logging.info(f'{print_datetime()}At iter {iteration}: rmse: RMSE = {rmse:.2e}, diff = {last_rmse - rmse:.2e},')
 
-        if model.M_constraint == 'sum2one':
+        if model.M_constraint == 'sum2one' and model.metagene_solver == 'native':
+            quadratic_terms = []
+            linear_term = np.zeros([model.max_genes, model.K])
+            for XT, statistics, num_genes, beta, sigma_yx_inverse in zip(model.XTs, model.statistics, model.Gs, model.betas, model.sigma_yx_inverses):
+                if model.dropout_mode == 'raw':
+                    quadratic_terms.append(statistics.XXT(XT) * (beta * sigma_yx_inverse**2))
+                    linear_term[:num_genes] -= statistics.YXT(XT) * (2 * beta * sigma_yx_inverse**2)
+                else:
+                    raise NotImplementedError(f'Dropout mode {model.dropout_mode} is not implemented')
+
+            # The regularization applies to every gene, as if from one more replicate that measures all of them
+            regularization_multiplier = 1e-2 / 2
+            quadratic_terms.append(regularization_multiplier * np.eye(model.K))
+            model.M = solve_column_simplex_qp(quadratic_terms, [*model.Gs, model.max_genes], linear_term, X=model.M)
+        elif model.M_constraint == 'sum2one':
             objective = 0
-            for XT, YT, num_genes, beta, sigma_yx_inverse in zip(model.XTs, model.YTs, model.Gs, model.betas, model.sigma_yx_inverses):
+            for XT, statistics, num_genes, beta, sigma_yx_inverse in zip(model.XTs, model.statistics, model.Gs, model.betas, model.sigma_yx_inverses):
                 if model.dropout_mode == 'raw':
                     # quadratic term
-                    XXT = XT.T @ XT * (beta * sigma_yx_inverse**2)
+                    XXT = statistics.XXT(XT) * (beta * sigma_yx_inverse**2)
                     objective += grb.quicksum(XXT[metagene, metagene] * metagene_parameters[gene, metagene] * metagene_parameters[gene, metagene] for gene in range(num_genes) for metagene in range(model.K))
                     XXT *= 2 # TODO: why 2?
                     objective += grb.quicksum(XXT[metagene, second_metagene] * metagene_parameters[gene, metagene] * metagene_parameters[gene, second_metagene]
                             for gene in range(num_genes) for metagene in range(model.K) for second_metagene in range(metagene+1, model.K))
 
                     # linear term
-                    YXT = YT.T @ XT * (-2 * beta * sigma_yx_inverse**2)
-                    YTY = np.dot(YT.ravel(), YT.ravel()) * beta * sigma_yx_inverse**2
+                    YXT = statistics.YXT(XT) * (-2 * beta * sigma_yx_inverse**2)
+                    YTY = statistics.YTY * beta * sigma_yx_inverse**2
                 else:
                     raise NotImplementedError(f'Dropout mode {model.dropout_mode} is not implemented')
 
@@ -218,7 +263,9 @@ def partial_nmf(model, prior_x_modes, initial_nmf_iterations, lambda_x=1, num_pr
             #     raise NotImplementedError(f'Constraint on M {model.M_constraint} is not implemented')
         # TODO: do we need to keep the below code block if it currently ends in a NotImplementedError?
         else:
-            YXTs = [(YT.T @ XT) * beta for YT, XT, beta in zip(model.YTs, model.XTs, model.betas)]
+            if model.metagene_solver == 'native':
+                raise NotImplementedError(f'Constraint on M {model.M_constraint} is not implemented')
+            YXTs = [statistics.YXT(XT) * beta for statistics, XT, beta in zip(model.statistics, model.XTs, model.betas)]
             objective_2s = []
             for XT, beta in zip(model.XTs, model.betas):
                 XXT = XT.T @ XT * beta
@@ -251,13 +298,16 @@ def partial_nmf(model, prior_x_modes, initial_nmf_iterations, lambda_x=1, num_pr
 
     return model.M, model.XTs, model.sigma_yx_inverses, model.prior_x_parameter_sets
 
-def initialize_M_by_kmeans(YTs, K, random_seed4kmeans=0, n_init=10):
+def initialize_M_by_kmeans(YTs, K, random_seed4kmeans=0, n_init=10, memory_budget=None, num_epochs=10):
     """Use k-means clustering for initial estimate of metagene matrix M.
 
     Args:
         YTs: A list of gene expression matrices, each with dimensions (num_individuals, num_genes)
         K: Inner-dimensionality of metagene matrix (i.e. number of metagenes desired)
         random_seed4kmeans:
+        memory_budget: if not None, YTs may be out-of-core, and mini-batch K-Means is run over blocks of rows of at most
+            memory_budget bytes instead of running K-Means on all cells at once
+        num_epochs: maximum number of passes over the cells for mini-batch K-Means
 
     Returns:
         M_initial, the initial estimate for the metagene matrix, with dimensions (num_genes, K)
@@ -266,10 +316,31 @@ def initialize_M_by_kmeans(YTs, K, random_seed4kmeans=0, n_init=10):
     num_cells_list, Gs = zip(*[YT.shape for YT in YTs])
     max_genes = max(Gs)
 
-    concatenated_expression_vectors = np.concatenate([YT for YT in YTs if YT.shape[1] == max_genes], axis=0)
-
     logging.info(f'{print_datetime()}random seed for K-Means = {random_seed4kmeans}')
     logging.info(f'{print_datetime()}n_init for K-Means = {n_init}')
+
+    if memory_budget is not None:
+        kmeans = MiniBatchKMeans(n_clusters=K, random_state=random_seed4kmeans, n_init=n_init)
+        last_centers = None
+        for epoch in range(num_epochs):
+            for YT in YTs:
+                if YT.shape[1] != max_genes:
+                    continue
+                # partial_fit needs at least K samples in its first batch
+                for _, YT_chunk in iterate_row_chunks(YT, max(get_chunk_size(YT, memory_budget), K)):
+                    kmeans.partial_fit(YT_chunk)
+
+            if last_centers is not None and np.abs(kmeans.cluster_centers_ - last_centers).max() < 1e-8:
+                break
+            last_centers = np.copy(kmeans.cluster_centers_)
+
+        return kmeans.cluster_centers_.T
+
+    # K-Means accepts CSR input, so sparse expression matrices are stacked without densifying them
+    if any(scipy.sparse.issparse(YT) for YT in YTs):
+        concatenated_expression_vectors = scipy.sparse.vstack([YT for YT in YTs if YT.shape[1] == max_genes], format='csr')
+    else:
+        concatenated_expression_vectors = np.concatenate([YT for YT in YTs if YT.shape[1] == max_genes], axis=0)
     
     kmeans = KMeans(
         n_clusters=K,
@@ -290,7 +361,7 @@ def initialize_sigma_x_inverse(K, XTs, Es, betas, sigma_x_inverse_mode):
     Args:
         K: number of metagenes
         XTs: list of initial weightings of metagenes for each replicate
-        Es: list of adjacency lists for connectivity graph of each replicate
+        Es: dictionary of neighborhood graphs (see :class:`adjacency.Adjacency`) of each replicate
         betas: list of beta factors that weight each replicate
     Returns:
         Initial estimate of pairwise affinity matrix (sigma_x_inverse).
@@ -305,13 +376,11 @@ def initialize_sigma_x_inverse(K, XTs, Es, betas, sigma_x_inverse_mode):
     elif sigma_x_inverse_mode.startswith('EmpiricalFromX'):
         factor = float(sigma_x_inverse_mode.split()[1])
         sigma_x = np.zeros([K, K])
-        for XT, adjacency_list, beta in zip(XTs, Es.values(), betas):
-            t = np.zeros_like(sigma_x)
-            for XTi, neighbors in zip(XT, adjacency_list.values()):
-                t += np.outer(XTi, XT[neighbors].sum(0))
+        for XT, adjacency, beta in zip(XTs, Es.values(), betas):
+            t = XT.T @ adjacency.neighbor_sum(XT)
             # TODO: seems like sigma_x isn't used anywhere. Can this safely be commented out, then?
             # self.sigma_x += t * beta
-        sigma_x /= np.dot(betas, [sum(map(len, E.values())) for E in Es.values()])
+        sigma_x /= np.dot(betas, [E.total_degree for E in Es.values()])
         sigma_x_inverse = np.linalg.inv(sigma_x)
         
         del sigma_x
@@ -1,66 +1,235 @@
-import os, pickle, logging
+import os, pickle, logging, shutil, itertools
 from matplotlib import pyplot as plt
 
 import numpy as np
+import scipy.io
+import scipy.sparse
+import h5py
 
-from util import print_datetime, parseSuffix
+from util import print_datetime, parseSuffix, load_sparse_hdf5_group
+from adjacency import Adjacency
 
-def load_expression(filename):
+def load_text_matrix(filename, mmap=False, chunk_size=2**12):
+    """Parse a whitespace-delimited matrix, caching it as a .npy file next to the source for later runs.
+
+    The text is parsed chunk_size lines at a time by numpy and appended to the cache, so that peak memory does not
+    exceed one chunk beyond the result. The cache is named after the size and modification time of the source, so it
+    is rebuilt whenever the source changes. If the cache cannot be written, the matrix is parsed into memory instead.
+
+    Args:
+        filename: path to the text file
+        mmap: whether to memory-map the cached matrix instead of reading it into memory
+        chunk_size: number of lines parsed at once
+
+    Returns:
+        The matrix as a float64 array.
+    """
+
+    status = os.stat(filename)
+    cache_path = filename.with_name(f'{filename.name}.{status.st_size}-{status.st_mtime_ns}.npy')
+    if cache_path.exists():
+        return np.load(cache_path, mmap_mode='r' if mmap else None)
+
+    raw_path = cache_path.with_name(f'{cache_path.name}.raw')
+    partial_path = cache_path.with_name(f'{cache_path.name}.partial')
+    try:
+        num_rows, num_columns = 0, None
+        with open(filename, 'rb') as text_file, open(raw_path, 'wb') as raw_file:
+            while True:
+                lines = list(itertools.islice(text_file, chunk_size))
+                if len(lines) == 0:
+                    break
+
+                lines = [line for line in lines if line.strip() and not line.lstrip().startswith(b'#')]
+                if len(lines) == 0:
+                    continue
+
+                # numpy's C parser splits on any whitespace, including the newlines between rows
+                chunk = np.fromstring(b''.join(lines).decode(), dtype=float, sep=' ')
+                if num_columns is None:
+                    num_columns = len(lines[0].split())
+                if len(chunk) != len(lines) * num_columns:
+                    raise ValueError(f'Rows {num_rows} to {num_rows + len(lines)} of {filename} do not all have {num_columns} numeric columns')
+
+                num_rows += len(lines)
+                chunk.tofile(raw_file)
+
+        with open(partial_path, 'wb') as cache_file, open(raw_path, 'rb') as raw_file:
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(float)), 'fortran_order': False, 'shape': (num_rows, num_columns or 0)}
+            np.lib.format.write_array_header_1_0(cache_file, header)
+            shutil.copyfileobj(raw_file, cache_file, 2**24)
+    except OSError as error:
+        logging.warning(f'Cannot cache {filename} ({error}); parsing it into memory')
+        if partial_path.exists():
+            partial_path.unlink()
+        return np.loadtxt(filename, dtype=float, ndmin=2)
+    finally:
+        if raw_path.exists():
+            raw_path.unlink()
+
+    # Remove caches of previous versions of the source
+    for stale_path in filename.parent.glob(f'{filename.name}.*.npy'):
+        stale_path.unlink()
+    os.replace(partial_path, cache_path)
+    logging.info(f'{print_datetime()}Cached {filename} as {cache_path}')
+
+    return np.load(cache_path, mmap_mode='r' if mmap else None)
+
+def load_hdf5_expression(filename, mmap=False, key='X'):
+    """Load the expression matrix from an HDF5 file, e.g. the X of an AnnData .h5ad file.
+
+    Dense datasets that are stored contiguously and uncompressed are memory-mapped directly if mmap is True.
+    Sparse matrices are stored as groups (see :func:`util.load_sparse_hdf5_group`).
+
+    Args:
+        filename: path to the HDF5 file
+        mmap: whether to memory-map the matrix when its layout allows it
+        key: name of the dataset or group; if absent and the file holds a single dataset, that dataset is used
+
+    Returns:
+        The expression matrix as an array or a scipy.sparse CSR matrix.
+    """
+
+    with h5py.File(filename, 'r') as f:
+        if key not in f:
+            datasets = [name for name, item in f.items() if isinstance(item, h5py.Dataset)]
+            if len(datasets) != 1:
+                raise ValueError(f'Cannot find the expression matrix {key} in {filename}')
+            key, = datasets
+
+        item = f[key]
+        if isinstance(item, h5py.Group):
+            return load_sparse_hdf5_group(item)
+
+        offset = item.id.get_offset()
+        if mmap and offset is not None and item.chunks is None and item.compression is None:
+            return np.memmap(filename, mode='r', dtype=item.dtype, shape=item.shape, offset=offset)
+
+        return item[()]
+
+def load_expression(filename, mmap=False):
     """Load gene expression data for spatial transcriptomics data.
 
+    Text files are cached as .npy files by :func:`load_text_matrix`. Sparse formats (.npz written by
+    scipy.sparse.save_npz, MatrixMarket .mtx and sparse HDF5 groups) are kept sparse as CSR matrices, which the rest
+    of the model handles without densifying them.
+
     Args:
-        filename: path to file (.txt or .pkl) that contains gene expression data.
+        filename: path to file (.txt, .pkl, .pickle, .npy, .h5, .hdf5, .h5ad, .npz or .mtx) that contains gene
+            expression data, with cells as rows
+        mmap: whether to memory-map .npy files, text caches and contiguous HDF5 datasets instead of reading them into
+            memory
 
     Returns:
-        (num_datapoints, num_genes) matrix of gene expression.
+        (num_datapoints, num_genes) matrix of gene expression, as an array or a scipy.sparse CSR matrix.
     """
 
-    if filename.suffix == '.pkl':
+    if filename.suffix in ('.pkl', '.pickle'):
         with open(filename, 'rb') as f:
             gene_expression = pickle.load(f)
     elif filename.suffix == '.txt':
-        gene_expression = np.loadtxt(filename, dtype=np.float)
+        gene_expression = load_text_matrix(filename, mmap=mmap)
+    elif filename.suffix == '.npy':
+        gene_expression = np.load(filename, mmap_mode='r' if mmap else None)
+    elif filename.suffix in ('.h5', '.hdf5', '.h5ad'):
+        gene_expression = load_hdf5_expression(filename, mmap=mmap)
+    elif filename.suffix == '.npz':
+        gene_expression = scipy.sparse.load_npz(filename)
+    elif filename.suffix == '.mtx':
+        gene_expression = scipy.sparse.csr_matrix(scipy.io.mmread(str(filename)))
     else:
         raise ValueError(f'Invalid file format for {filename}')
 
+    if scipy.sparse.issparse(gene_expression):
+        gene_expression = gene_expression.tocsr().astype(float)
+
     num_datapoints, num_genes = gene_expression.shape
     logging.info(f'{print_datetime()}Loaded {num_datapoints} cells and {num_genes} genes from {filename}')
    
     return gene_expression
 
+def load_edge_array(filename, key='edges'):
+    """Load the edges of a neighborhood graph as an array of node pairs.
+
+    Text files are cached as .npy files by :func:`load_text_matrix`. In HDF5 files, the edges are either a dataset of
+    node pairs or a sparse adjacency matrix stored as a group, e.g. obsp/spatial_connectivities of an AnnData .h5ad
+    file. Each non-zero entry of the matrix above or below the diagonal is an edge, and its diagonal is ignored.
+
+    Args:
+        filename: path to file (.txt, .npy, .h5, .hdf5 or .h5ad) that contains the edges
+        key: name of the dataset or group in an HDF5 file; if absent, obsp/spatial_connectivities is tried, and then
+            the single dataset of the file
+
+    Returns:
+        (num_edges, 2) int64 array of node IDs.
+    """
+
+    if filename.suffix == '.txt':
+        edges = load_text_matrix(filename)
+    elif filename.suffix == '.npy':
+        edges = np.load(filename)
+    elif filename.suffix in ('.h5', '.hdf5', '.h5ad'):
+        with h5py.File(filename, 'r') as f:
+            if key not in f:
+                key = 'obsp/spatial_connectivities'
+            if key not in f:
+                datasets = [name for name, item in f.items() if isinstance(item, h5py.Dataset)]
+                if len(datasets) != 1:
+                    raise ValueError(f'Cannot find the edges in {filename}')
+                key, = datasets
+
+            item = f[key]
+            if isinstance(item, h5py.Group):
+                matrix = load_sparse_hdf5_group(item)
+                matrix = scipy.sparse.triu(matrix + matrix.T, k=1).tocoo()
+                edges = np.stack([matrix.row, matrix.col], axis=1)
+            else:
+                edges = item[()]
+    else:
+        raise ValueError(f'Invalid file format for {filename}')
+
+    if edges.size == 0:
+        return np.zeros([0, 2], dtype=np.int64)
+    if not np.issubdtype(edges.dtype, np.integer):
+        if np.any(edges != np.round(edges)):
+            raise ValueError(f'Detected a non-integer node ID in {filename}')
+
+    return edges.astype(np.int64)
+
 def load_edges(filename, num_nodes):
     """Load HMRF edges for connectivity graph derived from spatial transcriptomics coordinates.
 
+    Duplicate edges are found with one sort of the edges packed into int64 keys, and the graph is built
+    directly as sorted CSR arrays by :meth:`adjacency.Adjacency.from_edges`.
+
     Args:
-        filename: path to .txt file that contains edges as tuples of node IDs.
+        filename: path to file (.txt, .npy, .h5, .hdf5 or .h5ad) that contains edges as tuples of node IDs (see
+            :func:`load_edge_array`).
         num_nodes: total number of nodes in connectivity graph.
 
     Returns:
-        A dictionary mapping each node ID to a list of node IDs that are its neighbors.
+        The neighborhood graph as an :class:`adjacency.Adjacency` in CSR format.
     """
 
-    edges = np.loadtxt(filename, dtype=np.int)
-    if edges.shape[1] != 2:
+    edges = load_edge_array(filename)
+    if edges.ndim != 2 or edges.shape[1] != 2:
         raise ValueError(f'Detected an edge that does not contain two nodes')
     if np.any(0 > edges) or np.any(edges >= num_nodes):
         raise ValueError(f'Node ID exceeded range [0, N)')
 
-    edges = np.sort(edges, axis=1)
-    if np.any(edges[:, 0] == edges[:, 1]):
-        raise ValueError(f'Detected {(edges[:, 0] == edges[:, 1]).sum()} self-loop(s)')
+    sources = np.minimum(edges[:, 0], edges[:, 1])
+    sinks = np.maximum(edges[:, 0], edges[:, 1])
+    if np.any(sources == sinks):
+        raise ValueError(f'Detected {(sources == sinks).sum()} self-loop(s)')
 
-    unique_edges = np.unique(edges, axis=0)
-    if len(unique_edges) != len(edges):
-        logging.warning(f'Detected {len(edges)-len(np.unique(edges, axis=0))} duplicate edge(s) from {len(edges)} loaded edges. Duplicate edges are discarded.')
-        edges = unique_edges
+    keys = np.sort(sources * num_nodes + sinks)
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    if len(keys) != len(edges):
+        logging.warning(f'Detected {len(edges)-len(keys)} duplicate edge(s) from {len(edges)} loaded edges. Duplicate edges are discarded.')
+    edges = np.stack([keys // num_nodes, keys % num_nodes], axis=1)
     logging.info(f'{print_datetime()}Loaded {len(edges)} edges from {filename}')
-    
-    adjacency_list = {node: [] for node in range(num_nodes)}
-    for (source, sink) in edges:
-        adjacency_list[source].append(sink)
-        adjacency_list[sink].append(source)
-    
-    return adjacency_list
+
+    return Adjacency.from_edges(edges, num_nodes)
 
 def loadGeneList(filename):
     genes = np.loadtxt(filename, dtype=str)
@@ -68,6 +68,55 @@ def parse_arguments():
 
     parser.add_argument('--num_threads', type=int, default=1, help='Number of CPU threads for PyTorch')
     parser.add_argument('--num_processes', type=int, default=1, help='Number of processes')
+    parser.add_argument(
+        '--weight_solver', type=str, default='native', choices=['native', 'gurobi'],
+        help='Solver for the per-cell weight subproblems; \'gurobi\' is kept as a reference and requires a license'
+    )
+    parser.add_argument(
+        '--metagene_solver', type=str, default='native', choices=['native', 'gurobi'],
+        help='Solver for the metagene subproblem; \'gurobi\' is kept as a reference and requires a license'
+    )
+    parser.add_argument(
+        '--icm_update_mode', type=str, default='sequential', choices=['sequential', 'colored'],
+        help='Order of cell updates in ICM; \'colored\' updates all cells of a graph color class together'
+    )
+    parser.add_argument(
+        '--icm_scheduling', type=str, default='full', choices=['full', 'dirty'],
+        help='Cells re-optimized by ICM in each sweep; \'dirty\' only revisits cells that changed and their neighbors'
+    )
+    parser.add_argument('--icm_prioritize', action='store_true', help='Whether ICM visits the cells that changed the most first')
+    parser.add_argument(
+        '--num_partitions', type=int, default=1,
+        help='Number of graph partitions per replicate; values > 1 let ICM on one large FOV use all processes'
+    )
+    parser.add_argument(
+        '--sigma_x_inverse_optimizer', type=str, default='adam', choices=['adam', 'lbfgs'],
+        help='Optimizer for the metagene affinity matrix; \'lbfgs\' runs full-batch L-BFGS with a line search'
+    )
+    parser.add_argument(
+        '--sigma_x_inverse_estimator', type=str, default='uniform', choices=['uniform', 'svrg'],
+        help='Gradient estimator for the mini-batch Adam steps; \'svrg\' adds control variates from the last full batch'
+    )
+    parser.add_argument(
+        '--sigma_x_inverse_batch_size', type=int, default=64,
+        help='Cells per mini-batch Adam step, per replicate for \'uniform\' and in total for \'svrg\''
+    )
+    parser.add_argument(
+        '--num_replicate_threads', type=int, default=1,
+        help='Number of threads evaluating replicates concurrently when optimizing the metagene affinity matrix'
+    )
+    parser.add_argument(
+        '--memory_budget', type=float, default=None,
+        help='Memory budget in MiB for blocks of expression data; if set, expression matrices are kept out-of-core'
+    )
+    parser.add_argument(
+        '--checkpoint_compression', type=str, default='gzip', choices=['gzip', 'lzf', 'none'],
+        help='Compression of the per-iteration history in the result file; \'lzf\' is faster but only readable by h5py'
+    )
+    parser.add_argument(
+        '--checkpoint_queue_size', type=int, default=2,
+        help='Checkpoints that may wait to be written in the background while the next iteration runs; 0 writes them synchronously'
+    )
     parser.add_argument('--result_filename', type=str, default="results.hdf5", help='The name of the h5 file to store results')
     parser.add_argument('--resume_training', action="store_true", help='Whether or not to resume training from a previous run')
 
@@ -103,6 +152,20 @@ if __name__ == '__main__':
         prior_x_modes=np.array(['Exponential shared fixed']*len(args.replicate_names)), 
         result_filename=args.result_filename,
         num_processes=args.num_processes,
+        weight_solver=args.weight_solver,
+        icm_update_mode=args.icm_update_mode,
+        icm_scheduling=args.icm_scheduling,
+        icm_prioritize=args.icm_prioritize,
+        num_partitions=args.num_partitions,
+        metagene_solver=args.metagene_solver,
+        memory_budget=None if args.memory_budget is None else args.memory_budget * 2**20,
+        sigma_x_inverse_optimizer=args.sigma_x_inverse_optimizer,
+        sigma_x_inverse_estimator=args.sigma_x_inverse_estimator,
+        sigma_x_inverse_batch_size=args.sigma_x_inverse_batch_size,
+        random_seed=args.random_seed,
+        num_replicate_threads=args.num_replicate_threads,
+        checkpoint_compression=None if args.checkpoint_compression == 'none' else args.checkpoint_compression,
+        checkpoint_queue_size=args.checkpoint_queue_size,
         resume_training=args.resume_training
     )
 
@@ -1,16 +1,20 @@
-import sys, time, itertools, psutil, resource, logging, h5py, os
+import sys, time, itertools, psutil, resource, logging, h5py, os, shutil, tempfile
+from contextlib import contextmanager
 from pathlib import Path
 import multiprocessing
 from multiprocessing import Pool
-from util import print_datetime, parseSuffix, openH5File, encode4h5, save_dict_to_hdf5, load_dict_from_hdf5_group, dict_to_list
+from util import print_datetime, parseSuffix, openH5File, encode4h5, load_dict_from_hdf5_group, load_history, dict_to_list, greedy_coloring, partition_graph, share_array, share_expression
 
 import numpy as np
-import gurobipy as grb
+import scipy.sparse
 import torch
 
+from adjacency import Adjacency
+from checkpoint import CheckpointWriter, CheckpointTransaction, BackgroundCheckpointWriter
+from sufficient_statistics import SufficientStatistics
 from load_data import load_expression, load_edges
 from initialization import initialize_M_by_kmeans, initialize_sigma_x_inverse, partial_nmf
-from estimate_weights import estimate_weights_icm, estimate_weights_no_neighbors
+from estimate_weights import estimate_weights_icm, estimate_weights_no_neighbors, estimate_weights_shared
 from estimate_parameters import estimate_parameters_x, estimate_parameters_y
 
 class SpiceMix:
@@ -22,16 +26,66 @@ class SpiceMix:
     Attributes:
         device: device to use for PyTorch operations
         num_processes: number of parallel processes to use for optimizing weights (should be <= #FOVs)
+        weight_solver: solver for the weight subproblems, including those of the NMF initialization; 'gurobi' or 'native'
+            (batched solvers in :mod:`solvers`)
+        metagene_solver: solver for the metagene subproblem; 'gurobi' or 'native' (see :func:`solvers.solve_column_simplex_qp`)
+        sigma_x_inverse_optimizer: optimizer for sigma_x_inverse; 'adam' or 'lbfgs' (see
+            :func:`estimate_parameters.estimate_sigma_x_inverse_lbfgs`)
+        sigma_x_inverse_estimator: gradient estimator for the mini-batch steps of the 'adam' optimizer; 'uniform' or
+            'svrg' (control variates from the full-batch gradient of the last epoch, see
+            :func:`estimate_parameters.estimate_parameters_x`)
+        sigma_x_inverse_batch_size: number of cells drawn in each mini-batch step, per replicate for 'uniform' and in
+            total for 'svrg', where they are split across replicates in proportion to betas
+        generator: seeded torch.Generator for the mini-batches of the 'svrg' estimator
+        num_replicate_threads: number of threads that evaluate the replicates concurrently in the sigma_x_inverse
+            optimizers (see :func:`estimate_parameters.map_replicates`)
+        icm_update_mode: order of cell updates in ICM; 'sequential' or 'colored' (see :func:`estimate_weights_icm`)
+        icm_scheduling: which cells ICM re-optimizes in each global iteration; 'full' or 'dirty'
+        icm_prioritize: whether ICM visits the cells that changed the most first
+        num_partitions: number of partitions to split each spatial replicate into, so that ICM on a single large
+            replicate can use all num_processes workers
+        memory_budget: if not None, number of bytes of expression data to process at once. Expression matrices are
+            then kept out-of-core as memory-mapped .npy files, and statistics are accumulated over blocks of rows
+        checkpoint_compression: HDF5 compression filter of the history in the result file; 'gzip', 'lzf' or None
+            (see :class:`checkpoint.CheckpointWriter`)
+        checkpoint_queue_size: maximum number of checkpoints waiting to be written by a background thread while the
+            next iteration runs, or 0 to write them synchronously (see :class:`checkpoint.BackgroundCheckpointWriter`)
         replicate_names: names of replicates/FOVs in input dataset
 
         TODO: finish docstring
     """
 
     def __init__(self, path2dataset, replicate_names, use_spatial, neighbor_suffix, expression_suffix, K,
-                 lambda_sigma_x_inverse, betas, prior_x_modes, result_filename, resume_training=False, device='cpu', num_processes=1):
+                 lambda_sigma_x_inverse, betas, prior_x_modes, result_filename, resume_training=False, device='cpu', num_processes=1, weight_solver='native', icm_update_mode='sequential',
+                 icm_scheduling='full', icm_prioritize=False, num_partitions=1, metagene_solver='native',
+                 memory_budget=None, sigma_x_inverse_optimizer='adam', sigma_x_inverse_estimator='uniform',
+                 sigma_x_inverse_batch_size=64, random_seed=0, num_replicate_threads=1, checkpoint_compression='gzip',
+                 checkpoint_queue_size=2):
 
         self.device = device
         self.num_processes = num_processes
+        self.weight_solver = weight_solver
+        self.metagene_solver = metagene_solver
+        self.memory_budget = memory_budget
+        self.sigma_x_inverse_optimizer = sigma_x_inverse_optimizer
+        self.sigma_x_inverse_estimator = sigma_x_inverse_estimator
+        self.sigma_x_inverse_batch_size = sigma_x_inverse_batch_size
+        self.generator = torch.Generator().manual_seed(random_seed)
+        self.num_replicate_threads = num_replicate_threads
+        self.thread_pool = None
+        self.checkpoint_compression = checkpoint_compression
+        self.checkpoint_queue_size = checkpoint_queue_size
+        self.icm_update_mode = icm_update_mode
+        self.icm_scheduling = icm_scheduling
+        self.icm_prioritize = icm_prioritize
+        self.num_partitions = num_partitions
+        self.partitions = {}
+        self.pool = None
+        self.diagnostics = None
+        self.shared_YT_paths = None
+        self.shared_adjacency_paths = None
+        self.torch_adjacencies = {}
+        self.colorings = {}
         self.epoch_size = 10
 
         self.M_constraint = 'sum2one'
@@ -41,6 +95,8 @@ class SpiceMix:
         self.pairwise_potential_mode = 'normalized'
         
         self.result_filename = Path(result_filename)
+        self.checkpoint_writer = None
+        self.checkpoint_transaction = None
         logging.info(f'{print_datetime()}result file = {self.result_filename}')
         
         if resume_training:
@@ -61,6 +117,7 @@ class SpiceMix:
     
             self.save_hyperparameters()
             self.save_dataset()
+            self.commit_checkpoint()
             
     def load_dataset(self, neighbor_suffix=None, expression_suffix=None):
         """Load spatial transcriptomics data from relevant filepaths.
@@ -78,30 +135,42 @@ class SpiceMix:
 
         self.unscaled_YTs = []
         for replicate in self.replicate_names:
-            # TODO: is it necessary to allow multiple extensions, or can we require that the expression data are
-            # in .txt files?
-            for extension in ['txt', 'pkl', 'pickle']:
+            # Binary formats come first, since they load much faster than text
+            for extension in ['npy', 'h5ad', 'h5', 'hdf5', 'npz', 'mtx', 'txt', 'pkl', 'pickle']:
                 filepath = self.path2dataset / 'files' / f'expression_{replicate}.{extension}'
                 if not filepath.exists():
                     continue
 
-                gene_expression = load_expression(filepath)
+                gene_expression = load_expression(filepath, mmap=self.memory_budget is not None)
                 self.unscaled_YTs.append(gene_expression)
+                break
         
         self.Ns, self.Gs = zip(*map(np.shape, self.unscaled_YTs))
         self.max_genes = max(self.Gs)
         
-        self.scaling = [G / self.max_genes * self.K / unscaled_YT.sum(axis=1).mean() for unscaled_YT, G in zip(self.unscaled_YTs, self.Gs)]
-        self.YTs = [scale * unscaled_YT for scale, unscaled_YT in zip(self.scaling, self.unscaled_YTs)]
+        unscaled_statistics = [SufficientStatistics(unscaled_YT, self.memory_budget) for unscaled_YT in self.unscaled_YTs]
+        self.scaling = [G / self.max_genes * self.K / statistics.row_sums.mean() for statistics, G in zip(unscaled_statistics, self.Gs)]
+        self.YTs = []
+        for replicate, (unscaled_YT, statistics, scale) in enumerate(zip(self.unscaled_YTs, unscaled_statistics, self.scaling)):
+            # Sparse matrices stay in memory, since scaling only touches their stored values
+            if self.memory_budget is None or scipy.sparse.issparse(unscaled_YT):
+                self.YTs.append(scale * unscaled_YT)
+            else:
+                self.YTs.append(self.scale_out_of_core(statistics, scale, self.result_filename.with_name(f'{self.result_filename.stem}_YT_{replicate}.npy')))
+        self.statistics = [SufficientStatistics(YT, self.memory_budget) for YT in self.YTs]
 
 
         self.Es = {}
         self.labels = {}
         for replicate_index, (replicate, num_nodes, use_spatial) in enumerate(zip(self.replicate_names, self.Ns, self.use_spatial)):
             if use_spatial:
-                E = load_edges(self.path2dataset / 'files' / f'neighborhood_{replicate}.txt', num_nodes)
+                for extension in ['npy', 'h5ad', 'h5', 'hdf5', 'txt']:
+                    filepath = self.path2dataset / 'files' / f'neighborhood_{replicate}.{extension}'
+                    if filepath.exists():
+                        break
+                E = load_edges(filepath, num_nodes)
             else:
-                E = {node: [] for node in range(num_nodes)}
+                E = Adjacency.empty(num_nodes)
 
             self.Es[replicate_index] = E
             
@@ -112,14 +181,26 @@ class SpiceMix:
                 
                 self.labels[replicate_index] = label
 
-        self.total_edge_counts = [sum(map(len, E.values())) for E in self.Es.values()]
+        self.total_edge_counts = [E.total_degree for E in self.Es.values()]
         self.gene_sets = {replicate: np.char.encode(np.loadtxt(self.path2dataset / 'files' / f'genes_{replicate}.txt', dtype=str), encoding="utf-8") for replicate in self.replicate_names}
 
+    @staticmethod
+    def scale_out_of_core(statistics, scale, path):
+        """Write the scaled expression matrix block by block to a .npy file, and memory-map it read-only."""
+
+        YT = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=statistics.YT.shape)
+        for rows, YT_chunk in statistics.row_chunks():
+            YT[rows] = scale * YT_chunk
+        YT.flush()
+        del YT
+
+        return np.load(path, mmap_mode='r')
+
     def initialize_model(self, random_seed4kmeans, lambda_x=1, initial_nmf_iterations=5, sigma_x_inverse_mode='Constant'):
         logging.info(f'{print_datetime()}Initialization begins')
         
         # initialize M
-        self.M = initialize_M_by_kmeans(self.YTs, self.K, random_seed4kmeans=random_seed4kmeans)
+        self.M = initialize_M_by_kmeans(self.YTs, self.K, random_seed4kmeans=random_seed4kmeans, memory_budget=self.memory_budget)
         if self.M_constraint == 'sum2one':
             self.M = np.maximum(self.M, 0)
             self.M /= self.M.sum(0, keepdims=True)
@@ -164,11 +245,13 @@ class SpiceMix:
     #     ret = initialize(self, *args, **kwargs)
         self.save_weights(iiter=0)
         self.save_parameters(iiter=0)
+        self.commit_checkpoint()
     #     return ret
 
     def reload_hyperparameters(self):
         with h5py.File(self.result_filename, 'r') as f:
             hyperparameters = load_dict_from_hdf5_group(f, 'hyperparameters/')
+            committed_iteration = f.attrs.get('committed_iteration')
 
         self.prior_x_modes = [hyperparameters["prior_x_modes"][replicate_name].decode("utf-8") for replicate_name in self.replicate_names]
         self.use_spatial = [hyperparameters["use_spatial"][replicate_name] for replicate_name in self.replicate_names]
@@ -176,23 +259,24 @@ class SpiceMix:
         self.betas = hyperparameters["betas"]
         self.K = int(hyperparameters["K"])
         self.completed_iterations = hyperparameters["completed_iterations"]
-        print(self.completed_iterations)
+        if committed_iteration is not None:
+            # completed_iterations may have been written by a checkpoint that was interrupted before its commit
+            self.completed_iterations = min(self.completed_iterations, committed_iteration - committed_iteration % self.epoch_size)
                     
     def reload_parameters(self):
         with h5py.File(self.result_filename, 'r') as f:
-            parameters = load_dict_from_hdf5_group(f, 'parameters/')
+            _, sigma_x_inverses = load_history(f, 'parameters/sigma_x_inverse')
+            _, Ms = load_history(f, 'parameters/M')
+            self.sigma_yx_inverses = np.array([load_history(f, f'parameters/sigma_yx_inverses/{replicate}')[1][-1] for replicate in range(self.num_replicates)])
+            self.prior_x_parameter = np.array([load_history(f, f'parameters/prior_x_parameter/{replicate}')[1][-1] for replicate in range(self.num_replicates)])
 
-        self.sigma_x_inverse = dict_to_list(parameters["sigma_x_inverse"])[-1]
-        self.M = dict_to_list(parameters["M"])[-1]
-        self.sigma_yx_inverses = np.array(dict_to_list(parameters["sigma_yx_inverses"]))[:, -1]
-        self.prior_x_parameter = np.array(dict_to_list(parameters["prior_x_parameter"]))[:, -1]
+        self.sigma_x_inverse = sigma_x_inverses[-1]
+        self.M = Ms[-1]
         self.prior_x_parameter_sets = [(prior_x_mode, prior_x_parameter) for prior_x_mode, prior_x_parameter in zip(self.prior_x_modes, self.prior_x_parameter)]
         
     def reload_weights(self):
         with h5py.File(self.result_filename, 'r') as f:
-            weights = load_dict_from_hdf5_group(f, 'weights/')
-            
-        self.XTs = dict_to_list(weights)[-1]
+            self.XTs = [load_history(f, f'weights/{replicate}')[1][-1] for replicate in range(self.num_replicates)]
 
     def reload_dataset(self):
         with h5py.File(self.result_filename, 'r') as f:
@@ -200,16 +284,11 @@ class SpiceMix:
        
         self.replicate_names = [replicate_name.decode('utf-8') for replicate_name in dataset["replicate_names"]]
         self.num_replicates = len(self.replicate_names)
-        self.Es = {}
-        for replicate_index in dataset["Es"].keys():
-            E = dataset["Es"][replicate_index]
-            new_E = {}
-            for node in E.keys():
-                new_E[int(node)] = E[node].astype(int)
-            self.Es[int(replicate_index)] = new_E
+        self.Es = {int(replicate_index): Adjacency.from_dict(E) for replicate_index, E in dataset["Es"].items()}
             
         self.unscaled_YTs = dict_to_list(dataset["unscaled_YTs"])
         self.YTs = dict_to_list(dataset["YTs"])
+        self.statistics = [SufficientStatistics(YT, self.memory_budget) for YT in self.YTs]
         
         if "labels" in dataset:
             self.labels = {}
@@ -223,7 +302,7 @@ class SpiceMix:
         
         self.Ns, self.Gs = zip(*map(np.shape, self.unscaled_YTs))
         self.max_genes = max(self.Gs)
-        self.total_edge_counts = [sum(map(len, E.values())) for E in dataset["Es"].values()]
+        self.total_edge_counts = [E.total_degree for E in self.Es.values()]
         
         self.scaling = dataset["scaling"]
         
@@ -236,27 +315,58 @@ class SpiceMix:
     def estimate_weights(self, iiter):
         logging.info(f'{print_datetime()}Updating latent states')
 
-        updated_XTs = []
-        with Pool(min(self.num_processes, self.num_replicates)) as pool:
+        if self.icm_update_mode == 'colored' or self.num_partitions > 1:
+            for replicate in range(self.num_replicates):
+                if self.total_edge_counts[replicate] > 0 and replicate not in self.colorings:
+                    self.colorings[replicate] = greedy_coloring(self.Es[replicate])
+
+        if self.num_partitions > 1:
             for replicate in range(self.num_replicates):
-                if self.total_edge_counts[replicate] == 0:
-                    updated_XTs.append(pool.apply_async(estimate_weights_no_neighbors, args=(
-                        self.YTs[replicate],
-                        self.M[:self.Gs[replicate]], self.XTs[replicate], self.prior_x_parameter_sets[replicate], self.sigma_yx_inverses[replicate],
-                        self.X_constraint, self.dropout_mode, replicate,
-                    )))
+                if self.total_edge_counts[replicate] > 0 and replicate not in self.partitions:
+                    self.partitions[replicate] = partition_graph(self.Es[replicate], self.num_partitions)
+
+        if self.pool is None:
+            self.flush_checkpoint_writer()
+        pool = self.pool if self.pool is not None else Pool(self.get_num_workers())
+
+        results = []
+        for replicate in range(self.num_replicates):
+            YT, E, G = self.YTs[replicate], self.Es[replicate], self.Gs[replicate]
+            if self.total_edge_counts[replicate] == 0:
+                args = (
+                    self.M[:G], self.XTs[replicate], self.prior_x_parameter_sets[replicate], self.sigma_yx_inverses[replicate],
+                    self.X_constraint, self.dropout_mode, replicate, self.weight_solver,
+                )
+                if self.shared_YT_paths is not None:
+                    results.append(pool.apply_async(estimate_weights_shared, args=(self.shared_YT_paths[replicate], None, *args)))
                 else:
-                    updated_XTs.append(pool.apply_async(estimate_weights_icm, args=(
-                        self.YTs[replicate], self.Es[replicate],
-                        self.M[:self.Gs[replicate]], self.XTs[replicate], self.prior_x_parameter_sets[replicate], self.sigma_yx_inverses[replicate], self.sigma_x_inverse,
-                        self.X_constraint, self.dropout_mode, self.pairwise_potential_mode, replicate,
-                    )))
+                    results.append(pool.apply_async(estimate_weights_no_neighbors, args=(YT, *args)))
+                continue
+
+            args = (
+                self.M[:G], self.XTs[replicate], self.prior_x_parameter_sets[replicate], self.sigma_yx_inverses[replicate], self.sigma_x_inverse,
+                self.X_constraint, self.dropout_mode, self.pairwise_potential_mode, replicate,
+                self.weight_solver, self.icm_update_mode, self.colorings.get(replicate), self.icm_scheduling, self.icm_prioritize,
+            )
+            if self.num_partitions > 1:
+                # Partitioned replicates are driven from this process, and their partitions are spread over the pool
+                results.append(estimate_weights_icm(YT, E, *args, partitions=self.partitions[replicate], pool=pool, statistics=self.statistics[replicate]))
+            elif self.shared_YT_paths is not None:
+                results.append(pool.apply_async(estimate_weights_shared, args=(self.shared_YT_paths[replicate], self.shared_adjacency_paths[replicate], *args)))
+            else:
+                results.append(pool.apply_async(estimate_weights_icm, args=(YT, E, *args)))
+
+        # Partitioned replicates are computed in this process, so their results are already available
+        results = [result.get(1e9) if isinstance(result, multiprocessing.pool.ApplyResult) else result for result in results]
+        self.XTs = [updated_XT for updated_XT, _ in results]
+        self.diagnostics = [diagnostics for _, diagnostics in results]
 
-            # TODO: is this line necessary? Seems like the results will always be of type ApplyResult
-            self.XTs = [updated_XT.get(1e9) if isinstance(updated_XT, multiprocessing.pool.ApplyResult) else updated_XT for updated_XT in updated_XTs]
-        pool.join()
+        if pool is not self.pool:
+            pool.close()
+            pool.join()
 
         self.save_weights(iiter=iiter)
+        self.save_diagnostics(iiter=iiter)
 
     def estimate_parameters(self, iiter):
         logging.info(f'{print_datetime()}Updating model parameters')
@@ -275,33 +385,136 @@ class SpiceMix:
 
         return self.Q
 
+    def get_torch_adjacency(self, replicate, torch_dtype):
+        """Sparse adjacency tensor of a replicate on self.device, built once and reused across iterations."""
+
+        key = (replicate, torch_dtype)
+        if key not in self.torch_adjacencies:
+            self.torch_adjacencies[key] = self.Es[replicate].to_torch(torch_dtype, self.device)
+
+        return self.torch_adjacencies[key]
+
+    def get_num_workers(self):
+        """Number of worker processes used for estimating weights."""
+
+        if self.num_partitions > 1:
+            return self.num_processes
+
+        return min(self.num_processes, self.num_replicates)
+
+    @contextmanager
+    def persistent_workers(self):
+        """Keep a worker pool and shared copies of the immutable data alive for the duration of the context.
+
+        The expression matrices and neighborhood graphs are written once to memory-mapped files that the workers
+        open on first use, so that each call to estimate_weights only pickles the parameters that change.
+        """
+
+        directory = tempfile.mkdtemp(prefix='spicemix_')
+        try:
+            self.shared_YT_paths = [share_expression(YT, directory, f'YT_{replicate}') for replicate, YT in enumerate(self.YTs)]
+            self.shared_adjacency_paths = []
+            for replicate, E in self.Es.items():
+                self.shared_adjacency_paths.append((
+                    share_array(E.indptr, directory, f'indptr_{replicate}'),
+                    share_array(E.indices, directory, f'indices_{replicate}'),
+                ))
+
+            self.flush_checkpoint_writer()
+            with Pool(self.get_num_workers()) as pool:
+                self.pool = pool
+                yield pool
+                pool.close()
+                pool.join()
+        finally:
+            self.pool = None
+            self.shared_YT_paths = None
+            self.shared_adjacency_paths = None
+            shutil.rmtree(directory, ignore_errors=True)
+
     def fit(self, max_iterations):
         """Fit SpiceMix model using NMF-HMRF updates.
 
         Alternately updates weights (XTs) and parameters (M, sigma_x_inverse, sigma_yx_inverse, prior_x_parameter_sets).
+        A single worker pool is kept for the whole run (see :meth:`persistent_workers`).
 
         Args:
             max_iterations: max number of complete iterations of NMF-HMRF updates.
         """
 
         last_Q = np.nan
-        for iteration in range(self.completed_iterations + 1, max_iterations + 1):
-            logging.info(f'{print_datetime()}Iteration {iteration} begins')
+        try:
+            with self.persistent_workers():
+                for iteration in range(self.completed_iterations + 1, max_iterations + 1):
+                    logging.info(f'{print_datetime()}Iteration {iteration} begins')
 
-            self.estimate_weights(iiter=iteration)
-            self.estimate_parameters(iiter=iteration)
-            logging.info(f'{print_datetime()}Q = {self.Q:.4f}\tdiff Q = {self.Q-last_Q:.4e}')
-            last_Q = self.Q
-            
-            if self.is_checkpoint_iteration(iteration):
-                self.completed_iterations += self.epoch_size
-                
-            self.save_progress(iiter=iteration)
+                    self.estimate_weights(iiter=iteration)
+                    self.estimate_parameters(iiter=iteration)
+                    logging.info(f'{print_datetime()}Q = {self.Q:.4f}\tdiff Q = {self.Q-last_Q:.4e}')
+                    last_Q = self.Q
+
+                    if self.is_checkpoint_iteration(iteration):
+                        self.completed_iterations += self.epoch_size
+
+                    self.save_progress(iiter=iteration)
+                    self.commit_checkpoint()
+        finally:
+            # The checkpoint of an interrupted iteration is incomplete, so it is discarded
+            self.checkpoint_transaction = None
+            self.close_checkpoint_writer()
 
 
     def is_checkpoint_iteration(self, iiter):
         return iiter % self.epoch_size == 0
 
+    def get_checkpoint_writer(self):
+        """Open the result file on first use and keep it open until :meth:`close_checkpoint_writer`."""
+
+        if self.checkpoint_writer is None:
+            writer = CheckpointWriter(self.result_filename, compression=self.checkpoint_compression)
+            if self.checkpoint_queue_size > 0:
+                writer = BackgroundCheckpointWriter(writer, max_pending=self.checkpoint_queue_size)
+            self.checkpoint_writer = writer
+
+        return self.checkpoint_writer
+
+    def get_checkpoint_transaction(self):
+        """Updates of the result file collected by the save methods until :meth:`commit_checkpoint`."""
+
+        if self.checkpoint_transaction is None:
+            self.checkpoint_transaction = CheckpointTransaction()
+
+        return self.checkpoint_transaction
+
+    def commit_checkpoint(self):
+        """Write the collected updates of the result file as one transaction, in the background if checkpoint_queue_size > 0.
+
+        The arrays were copied when they were saved, so the next iteration may modify them in place.
+        """
+
+        if self.checkpoint_transaction is None:
+            return
+
+        transaction, self.checkpoint_transaction = self.checkpoint_transaction, None
+        self.get_checkpoint_writer().submit(transaction)
+
+    def flush_checkpoint_writer(self):
+        """Wait for the pending checkpoints to be written.
+
+        Called before forking worker processes: a fork while the background writer holds a lock, e.g. in h5py or
+        logging, would leave that lock held forever in the workers.
+        """
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
+
+    def close_checkpoint_writer(self):
+        """Wait for the pending checkpoints to be written and close the result file."""
+
+        if self.checkpoint_writer is not None:
+            writer, self.checkpoint_writer = self.checkpoint_writer, None
+            writer.close()
+
     def save_dataset(self):
         state_update = {
             "dataset": {
@@ -309,14 +522,15 @@ class SpiceMix:
                 "YTs": {replicate: YT for replicate, YT in enumerate(self.YTs)},
                 "scaling": self.scaling,
                 "unscaled_YTs": {replicate: unscaled_YT for replicate, unscaled_YT in enumerate(self.unscaled_YTs)},
-                "Es": self.Es,
+                "Es": {replicate: E.to_dict() for replicate, E in self.Es.items()},
                 "gene_sets": self.gene_sets,
                 "labels": self.labels,
                 # "coordinates": {replicate: coordinate for replicate, coordinate in enumerate(self.coordinates)}
             }
         }
 
-        save_dict_to_hdf5(self.result_filename, state_update)
+        # The expression matrices are never modified, so they are written without a copy
+        self.get_checkpoint_transaction().write(state_update, copy=False)
 
     def save_hyperparameters(self):
         # if self.result_filename is None: return
@@ -336,7 +550,7 @@ class SpiceMix:
             }
         }
 
-        save_dict_to_hdf5(self.result_filename, state_update)
+        self.get_checkpoint_transaction().write(state_update)
             # f['hyperparameters/replicate_names'] = [replicate_name.encode('utf-8') for replicate_name in self.replicate_names]
             # for repli, v in zip(self.replicate_names, self.prior_x_modes):
             #     f[f'hyperparameters/{k}/{repli}'] = encode4h5(v)
@@ -345,14 +559,24 @@ class SpiceMix:
 
     def save_weights(self, iiter):
         if self.is_checkpoint_iteration(iiter):
-            print("saving weights")
             state_update = {
                 "weights": {
-                    replicate_index: {iiter: XT} for replicate_index, XT in zip(range(self.num_replicates), self.XTs)
+                    replicate_index: XT for replicate_index, XT in zip(range(self.num_replicates), self.XTs)
                 }
             }
-            
-            save_dict_to_hdf5(self.result_filename, state_update)
+
+            self.get_checkpoint_transaction().append(state_update, iiter)
+
+    def save_diagnostics(self, iiter):
+        """Save the solver statistics of the last weight estimation (see :func:`estimate_weights.create_diagnostics`)."""
+
+        state_update = {
+            "diagnostics": {
+                replicate_index: diagnostics for replicate_index, diagnostics in zip(range(self.num_replicates), self.diagnostics)
+            }
+        }
+
+        self.get_checkpoint_transaction().append(state_update, iiter)
 
     def save_parameters(self, iiter):
         # if self.result_filename is None:
@@ -360,33 +584,20 @@ class SpiceMix:
         if self.is_checkpoint_iteration(iiter):
             state_update = {
                 "parameters": {
-                    "sigma_x_inverse": {
-                        iiter: self.sigma_x_inverse
-                    },
-                    "M": {
-                        iiter: self.M
-                    },
+                    "sigma_x_inverse": self.sigma_x_inverse,
+                    "M": self.M,
                     "sigma_yx_inverses": {
-                        replicate_index: {iiter: sigma_yx_inverse} for replicate_index, sigma_yx_inverse in zip(range(self.num_replicates), self.sigma_yx_inverses)
+                        replicate_index: sigma_yx_inverse for replicate_index, sigma_yx_inverse in zip(range(self.num_replicates), self.sigma_yx_inverses)
                     },
                     "prior_x_parameter": {
-                        replicate_index: {iiter: prior_x_parameters} for replicate_index, (_, prior_x_parameters) in zip(range(self.num_replicates), self.prior_x_parameter_sets)
+                        replicate_index: prior_x_parameters for replicate_index, (_, prior_x_parameters) in zip(range(self.num_replicates), self.prior_x_parameter_sets)
                     }
                 }
             }
-        
-            save_dict_to_hdf5(self.result_filename, state_update)
+
+            self.get_checkpoint_transaction().append(state_update, iiter)
 
     def save_progress(self, iiter):
-        state_update = {
-            "progress": {
-                "Q": {
-                    iiter: self.Q
-                }
-            },
-            "hyperparameters": {
-                "completed_iterations": self.completed_iterations
-            }
-        }
-        
-        save_dict_to_hdf5(self.result_filename, state_update)
\ No newline at end of file
+        transaction = self.get_checkpoint_transaction()
+        transaction.append({"progress": {"Q": self.Q}}, iiter)
+        transaction.write({"hyperparameters": {"completed_iterations": self.completed_iterations}})
\ No newline at end of file
@@ -7,13 +7,7 @@ import scipy
 from scipy.stats import truncnorm, multivariate_normal, mvn
 from scipy.special import erf, loggamma
 
-from util import PyTorchDType as dtype
-
-n_cache = 2**14
-precomputed_log_gamma_tensor = None
-tarange = None
-# precomputed_log_gamma_tensor = torch.tensor(loggamma(np.arange(1, n_cache)), dtype=dtype, device=device)
-# tarange = torch.arange(n_cache, dtype=dtype, device=device)
+from util import PyTorchDType as dtype, get_coefficient_table
 
 
 def sampleFromSimplex(n, D, seed=None):
@@ -419,8 +413,8 @@ def integrateOfExponentialOverSimplexInduction(teta, grad=None, requires_grad=Fa
 
         tetas = teta
         trets = []
-        tidx = tarange[D-1: D+nterm-1]
-        tlg = precomputed_log_gamma_tensor[D-1: D+nterm-1]
+        tidx = get_coefficient_table('arange', dtype=dtype, device=device)[D-1: D+nterm-1]
+        tlg = get_coefficient_table('log_gamma', dtype=dtype, device=device)[D-1: D+nterm-1]
         for teta in tetas.split(chunk_size, 0):
         # tret = trets
         # teta = tetas
@@ -493,8 +487,8 @@ def integrateOfExponentialOverSimplexInduction(teta, grad=None, requires_grad=Fa
         # print(teta)
         tetas = teta
         trets = torch.empty(len(teta), dtype=dtype, device=device)
-        tidx = tarange[D-1:D+nterm-1]
-        tlg = precomputed_log_gamma_tensor[D-1: D+nterm-1]
+        tidx = get_coefficient_table('arange', dtype=dtype, device=device)[D-1: D+nterm-1]
+        tlg = get_coefficient_table('log_gamma', dtype=dtype, device=device)[D-1: D+nterm-1]
         for tret, teta, teta_grad in zip(trets.split(chunk_size, 0), tetas.split(chunk_size, 0), tetas.grad.split(chunk_size, 0)):
             A = torch.empty([len(teta), D], dtype=dtype, device=device)
             Asign = torch.empty_like(A)
@@ -584,7 +578,7 @@ def integrate_over_simplex(beta_i_tensor, grad=None, requires_grad=False, device
         grad = torch.tensor([1.], dtype=dtype, device=device)
 
     if precomputed_log_gamma_tensor is None:
-        precomputed_log_gamma_tensor = torch.tensor(loggamma(np.arange(1, n_cache)), dtype=dtype, device=device)
+        precomputed_log_gamma_tensor = get_coefficient_table('log_gamma', dtype=dtype, device=device)
 
     beta_i_tensor_offset = beta_i_tensor.max(axis=-1, keepdim=True)[0] + 1e-5
     sigma_x_inverse_range = (beta_i_tensor.max() - beta_i_tensor.min()).item()
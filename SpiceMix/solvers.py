@@ -0,0 +1,262 @@
+import numpy as np
+
+def solve_nonnegative_qp(A, B, X=None, max_iterations=1000, tolerance=1e-6):
+    """Solve a batch of non-negative quadratic programs that share their quadratic term.
+
+    Each row x_i of the solution minimizes x_i^T A x_i + b_i^T x_i subject to x_i >= 0. The problems are solved
+    simultaneously by cyclic coordinate descent, where every coordinate update is the exact minimizer along that
+    coordinate clipped at zero. Since A is shared, each coordinate update is a rank-one update of the cached
+    product X @ A across all rows.
+
+    Args:
+        A: symmetric positive definite quadratic term, with shape (K, K)
+        B: linear terms for each problem, with shape (num_problems, K)
+        X: optional initial estimate for the solutions, with shape (num_problems, K)
+        max_iterations: maximum number of sweeps over the K coordinates
+        tolerance: convergence threshold on the maximum change of any coordinate within a sweep
+
+    Returns:
+        Array of solutions with shape (num_problems, K).
+    """
+
+    num_problems, K = B.shape
+    if X is None:
+        X = np.zeros([num_problems, K], dtype=float)
+    else:
+        X = np.maximum(X, 0).astype(float)
+
+    diagonal = 2 * np.diag(A)
+    assert (diagonal > 0).all()
+
+    XA = X @ A
+    for iteration in range(max_iterations):
+        max_delta = 0
+        for k in range(K):
+            gradient = 2 * XA[:, k] + B[:, k]
+            x_k = np.maximum(X[:, k] - gradient / diagonal[k], 0)
+            delta = x_k - X[:, k]
+            X[:, k] = x_k
+            XA += np.outer(delta, A[k])
+            max_delta = max(max_delta, np.abs(delta).max(initial=0))
+
+        if max_delta < tolerance * max(1, np.abs(X).max(initial=0)):
+            break
+
+    return X
+
+def project_onto_simplex(Z):
+    """Project each row of Z onto the probability simplex {z : z >= 0, sum(z) = 1}.
+
+    Uses the sort-based algorithm of Held et al. (1974), vectorized across rows.
+
+    Args:
+        Z: array with shape (num_problems, K)
+
+    Returns:
+        Array of the same shape whose rows are the Euclidean projections of the rows of Z.
+    """
+
+    num_problems, K = Z.shape
+    sorted_Z = -np.sort(-Z, axis=1)
+    cumulative_sums = sorted_Z.cumsum(axis=1) - 1
+    thresholds = cumulative_sums / np.arange(1, K+1)
+    support_sizes = (sorted_Z > thresholds).sum(axis=1)
+    threshold = thresholds[np.arange(num_problems), support_sizes - 1]
+
+    return np.maximum(Z - threshold[:, None], 0)
+
+def solve_simplex_qp_on_support(A, B, support, scale, tolerance=1e-9):
+    """Solve a batch of simplex-constrained quadratic programs on a guessed support, and check optimality.
+
+    For each row, the coordinates outside support are fixed to zero, and the equality-constrained problem on the
+    support is solved in closed form from its KKT system
+
+        2 * scale_i * A_SS z_S + b_S + nu 1 = 0,    1^T z_S = 1.
+
+    The solution is optimal for the full problem if it is non-negative and the gradient plus nu is non-negative on
+    the coordinates outside the support. Rows are padded to a common size with an identity block so that all KKT
+    systems are solved with one batched call.
+
+    Args:
+        A: symmetric positive semidefinite quadratic term, with shape (K, K)
+        B: linear terms for each problem, with shape (num_problems, K)
+        support: boolean array of coordinates allowed to be non-zero, with shape (num_problems, K)
+        scale: non-negative scale of the quadratic term for each problem, with shape (num_problems,)
+        tolerance: tolerance on the KKT conditions, relative to the magnitude of each problem
+
+    Returns:
+        Array of candidate solutions with shape (num_problems, K), and a boolean array with shape (num_problems,) that
+        is True for rows whose candidate satisfies the KKT conditions of the full problem.
+    """
+
+    num_problems, K = B.shape
+
+    off_support = ~support
+    kkt_matrices = np.zeros([num_problems, K+1, K+1])
+    kkt_matrices[:, :K, :K] = 2 * scale[:, None, None] * A * (support[:, :, None] & support[:, None, :])
+    kkt_matrices[:, np.arange(K), np.arange(K)] += off_support
+    kkt_matrices[:, :K, K] = support
+    kkt_matrices[:, K, :K] = support
+    kkt_vectors = np.concatenate([-B * support, np.ones([num_problems, 1])], axis=1)
+
+    try:
+        solutions = np.linalg.solve(kkt_matrices, kkt_vectors[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        return np.zeros_like(B), np.zeros(num_problems, dtype=bool)
+
+    Z = solutions[:, :K] * support
+    multiplier = solutions[:, K]
+
+    magnitude = scale * np.abs(A).max() + np.abs(B).max(axis=1) + 1e-30
+    reduced_gradient = 2 * scale[:, None] * (Z @ A) + B + multiplier[:, None]
+    is_optimal = (
+        np.isfinite(solutions).all(axis=1)
+        & (Z >= -tolerance).all(axis=1)
+        & ((reduced_gradient >= -tolerance * magnitude[:, None]) | support).all(axis=1)
+    )
+
+    Z = np.maximum(Z, 0)
+    Z /= Z.sum(axis=1, keepdims=True) + 1e-30
+
+    return Z, is_optimal
+
+def solve_simplex_qp(A, B, Z=None, scale=None, max_iterations=1000, tolerance=1e-6, largest_eigenvalue=None, active_set=True):
+    """Solve a batch of simplex-constrained quadratic programs that share their quadratic term up to a scale.
+
+    Each row z_i of the solution minimizes scale_i * z_i^T A z_i + b_i^T z_i subject to z_i >= 0 and sum(z_i) = 1,
+    using accelerated projected gradient descent (FISTA) with exact projection onto the simplex and gradient-based
+    adaptive restart of the momentum. Each objective is first divided by its own magnitude, so that rows whose
+    quadratic term vanishes (e.g. a size factor close to zero) remain well-scaled, and the step size of each row is the
+    inverse of the Lipschitz constant of its gradient. Rows are dropped from the batch as soon as they converge.
+
+    The support of the solution (which coordinates are non-zero) rarely changes between successive calls with similar
+    problems, e.g. across ICM and EM iterations, so when active_set is True and an initial estimate is given, its
+    support is first tried with :func:`solve_simplex_qp_on_support`. Only the rows whose KKT conditions fail on that
+    support are passed on to FISTA.
+
+    Args:
+        A: symmetric positive semidefinite quadratic term, with shape (K, K)
+        B: linear terms for each problem, with shape (num_problems, K)
+        Z: optional initial estimate for the solutions, with shape (num_problems, K)
+        scale: optional non-negative scale of the quadratic term for each problem, with shape (num_problems,)
+        max_iterations: maximum number of gradient steps
+        tolerance: convergence threshold on the maximum change of any coordinate in one step
+        largest_eigenvalue: optional precomputed largest eigenvalue of A, for callers that solve many small batches
+        active_set: whether to first try the support of Z in closed form
+
+    Returns:
+        Array of solutions with shape (num_problems, K).
+    """
+
+    num_problems, K = B.shape
+    is_warm_started = Z is not None
+    if Z is None:
+        Z = np.full([num_problems, K], 1 / K)
+    else:
+        Z = project_onto_simplex(Z)
+
+    if scale is None:
+        scale = np.ones(num_problems)
+
+    active = np.arange(num_problems)
+    if active_set and is_warm_started:
+        Z_support, is_optimal = solve_simplex_qp_on_support(A, B, Z > 0, scale)
+        Z[is_optimal] = Z_support[is_optimal]
+        active = active[~is_optimal]
+        if len(active) == 0:
+            return Z
+
+    if largest_eigenvalue is None:
+        largest_eigenvalue = np.linalg.eigvalsh(A)[-1]
+    magnitude = scale * largest_eigenvalue + np.abs(B).max(axis=1) + 1e-30
+    scale = (scale / magnitude)[:, None]
+    B = B / magnitude[:, None]
+    step_size = 1 / (2 * scale * largest_eigenvalue + 1e-12)
+
+    # Extrapolated points and momentum coefficients of FISTA
+    Y = Z.copy()
+    momentum = np.ones(num_problems)
+
+    for iteration in range(max_iterations):
+        Z_active = Z[active]
+        Y_active = Y[active]
+        gradient = 2 * scale[active] * (Y_active @ A) + B[active]
+        updated_Z = project_onto_simplex(Y_active - step_size[active] * gradient)
+        delta_Z = updated_Z - Z_active
+
+        # Restart the momentum of rows where it points uphill
+        restart = (gradient * delta_Z).sum(axis=1) > 0
+        updated_momentum = np.where(restart, 1, (1 + np.sqrt(1 + 4 * momentum[active]**2)) / 2)
+        extrapolation = np.where(restart, 0, (momentum[active] - 1) / updated_momentum)
+
+        Z[active] = updated_Z
+        Y[active] = updated_Z + extrapolation[:, None] * delta_Z
+        momentum[active] = updated_momentum
+
+        active = active[np.abs(delta_Z).max(axis=1) >= tolerance]
+        if len(active) == 0:
+            break
+
+    return Z
+
+def solve_column_simplex_qp(quadratic_terms, row_counts, B, X=None, max_iterations=10000, tolerance=1e-6):
+    """Solve a quadratic program over matrices whose columns lie on the probability simplex.
+
+    The solution X minimizes sum_r tr(X[:n_r] A_r X[:n_r]^T) + sum(B * X) subject to X >= 0 and each column of X
+    summing to one, where the r-th quadratic term A_r only applies to the first n_r rows of X. This is the form of the
+    metagene update, in which replicate r measures only the first n_r genes. The problem is solved by accelerated
+    projected gradient descent (FISTA) with column-wise projection onto the simplex and gradient-based adaptive
+    restart of the momentum.
+
+    Args:
+        quadratic_terms: list of symmetric positive semidefinite quadratic terms A_r, each with shape (K, K)
+        row_counts: number of rows n_r of X that each quadratic term applies to
+        B: linear term, with shape (num_rows, K)
+        X: optional initial estimate of the solution, with shape (num_rows, K)
+        max_iterations: maximum number of gradient steps
+        tolerance: convergence threshold on the maximum change of any entry in one step, relative to the largest
+            entry of X
+
+    Returns:
+        Solution with shape (num_rows, K).
+    """
+
+    num_rows, K = B.shape
+    if X is None:
+        X = np.full([num_rows, K], 1 / num_rows)
+    else:
+        X = project_onto_simplex(X.T).T
+
+    # Every row sees a subset of the quadratic terms, so their sum bounds the curvature of all rows
+    largest_eigenvalue = np.linalg.eigvalsh(sum(quadratic_terms))[-1]
+    step_size = 1 / (2 * largest_eigenvalue + 1e-30)
+
+    def calculate_gradient(X):
+        gradient = np.copy(B)
+        for A, row_count in zip(quadratic_terms, row_counts):
+            gradient[:row_count] += 2 * X[:row_count] @ A
+
+        return gradient
+
+    Y = X.copy()
+    momentum = 1
+    for iteration in range(max_iterations):
+        gradient = calculate_gradient(Y)
+        updated_X = project_onto_simplex((Y - step_size * gradient).T).T
+        delta_X = updated_X - X
+
+        # Restart the momentum when it points uphill
+        if (gradient * delta_X).sum() > 0:
+            updated_momentum, extrapolation = 1, 0
+        else:
+            updated_momentum = (1 + np.sqrt(1 + 4 * momentum**2)) / 2
+            extrapolation = (momentum - 1) / updated_momentum
+
+        X = updated_X
+        Y = updated_X + extrapolation * delta_X
+        momentum = updated_momentum
+
+        if np.abs(delta_X).max() < tolerance * X.max():
+            break
+
+    return X
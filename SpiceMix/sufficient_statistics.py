@@ -0,0 +1,149 @@
+import numpy as np
+import scipy.sparse
+
+def get_chunk_size(YT, memory_budget=None):
+    """Number of rows of YT that fit in memory_budget bytes as float64, or all rows if memory_budget is None.
+
+    For scipy.sparse matrices, the size of a row is the average size of its stored values and column indices.
+    """
+
+    num_rows, num_columns = YT.shape
+    if memory_budget is None:
+        return max(num_rows, 1)
+
+    if scipy.sparse.issparse(YT):
+        row_size = 12 * YT.nnz / max(num_rows, 1) + 4
+    else:
+        row_size = 8 * max(num_columns, 1)
+
+    return max(int(memory_budget // row_size), 1)
+
+def iterate_row_chunks(YT, chunk_size):
+    """Iterate over consecutive row blocks of YT, which may be a memory-mapped array, an HDF5 dataset or a
+    scipy.sparse CSR matrix.
+
+    Yields:
+        Slices of rows and the corresponding rows of YT as in-memory float64 arrays, or as CSR matrices if YT is
+        sparse.
+    """
+
+    num_rows, _ = YT.shape
+    for start in range(0, num_rows, chunk_size):
+        rows = slice(start, min(start + chunk_size, num_rows))
+        if scipy.sparse.issparse(YT):
+            YT_chunk = YT if chunk_size >= num_rows else YT[rows]
+            yield rows, YT_chunk.astype(float, copy=False)
+        else:
+            yield rows, np.asarray(YT[rows], dtype=float)
+
+class SufficientStatistics:
+    """Products of the expression matrix of one replicate with the current model, shared across optimization stages.
+
+    YTY is computed once, since YT is fixed for the whole run. The products with the weights (YXT, XXT) and with
+    the metagenes (YTM, MTM) are recomputed only when the XT or M they are requested for differs from the one of the
+    cached value, so that the weight step, the M-step, the σ_y|x update and the NMF initialization can all ask for
+    them without repeating O(N·G·K) products.
+
+    YT may also be a memory-mapped array or an HDF5 dataset that does not fit in memory. All products are then
+    accumulated over blocks of rows, each of at most memory_budget bytes, and only matrices with one dimension of
+    size K are kept in memory. If YT is a scipy.sparse CSR matrix, it is never densified, and the products cost
+    O(nnz·K) instead of O(N·G·K).
+
+    Attributes:
+        YT: transpose of gene expression matrix for the replicate, with shape (num_cells, num_genes)
+        YTY: squared Frobenius norm of YT
+        row_squared_norms: squared norm of each row of YT, i.e. of the expression of each cell
+        chunk_size: number of rows of YT processed at once
+    """
+
+    def __init__(self, YT, memory_budget=None):
+        self.YT = YT
+        self.chunk_size = get_chunk_size(YT, memory_budget)
+
+        num_cells, num_genes = YT.shape
+        self.YTY = 0.
+        self.row_sums = np.empty(num_cells)
+        self.row_squared_norms = np.empty(num_cells)
+        self.column_sums = np.zeros(num_genes)
+        self.column_squared_sums = np.zeros(num_genes)
+        for rows, YT_chunk in self.row_chunks():
+            if scipy.sparse.issparse(YT_chunk):
+                self.YTY += np.dot(YT_chunk.data, YT_chunk.data)
+                squares = YT_chunk.multiply(YT_chunk)
+                self.column_squared_sums += np.asarray(squares.sum(axis=0)).ravel()
+                self.row_squared_norms[rows] = np.asarray(squares.sum(axis=1)).ravel()
+            else:
+                self.YTY += np.dot(YT_chunk.ravel(), YT_chunk.ravel())
+                self.column_squared_sums += np.einsum('ij,ij->j', YT_chunk, YT_chunk)
+                self.row_squared_norms[rows] = np.einsum('ij,ij->i', YT_chunk, YT_chunk)
+            self.row_sums[rows] = np.asarray(YT_chunk.sum(axis=1)).ravel()
+            self.column_sums += np.asarray(YT_chunk.sum(axis=0)).ravel()
+
+        self._XT = None
+        self._YXT = None
+        self._XXT = None
+        self._M = None
+        self._YTM = None
+        self._MTM = None
+
+    def row_chunks(self):
+        """Iterate over blocks of rows of YT (see :func:`iterate_row_chunks`)."""
+
+        return iterate_row_chunks(self.YT, self.chunk_size)
+
+    @property
+    def column_std(self):
+        """Standard deviation of each gene across cells."""
+
+        num_cells, _ = self.YT.shape
+        mean = self.column_sums / num_cells
+        return np.sqrt(np.maximum(self.column_squared_sums / num_cells - mean**2, 0))
+
+    def update_weights(self, XT):
+        if self._XT is None or self._XT.shape != XT.shape or not np.array_equal(self._XT, XT):
+            self._XT = np.array(XT, copy=True)
+            self._YXT = sum(YT_chunk.T @ XT[rows] for rows, YT_chunk in self.row_chunks())
+            self._XXT = XT.T @ XT
+
+    def update_metagenes(self, M):
+        if self._M is None or self._M.shape != M.shape or not np.array_equal(self._M, M):
+            self._M = np.array(M, copy=True)
+            self._YTM = np.concatenate([YT_chunk @ M for _, YT_chunk in self.row_chunks()], axis=0)
+            self._MTM = M.T @ M
+
+    def YXT(self, XT):
+        """YT.T @ XT, with shape (num_genes, num_metagenes)."""
+
+        self.update_weights(XT)
+        return self._YXT
+
+    def XXT(self, XT):
+        """XT.T @ XT, with shape (num_metagenes, num_metagenes)."""
+
+        self.update_weights(XT)
+        return self._XXT
+
+    def YTM(self, M):
+        """YT @ M, with shape (num_cells, num_metagenes)."""
+
+        self.update_metagenes(M)
+        return self._YTM
+
+    def MTM(self, M):
+        """M.T @ M, with shape (num_metagenes, num_metagenes)."""
+
+        self.update_metagenes(M)
+        return self._MTM
+
+    def squared_error(self, M, XT):
+        """Squared Frobenius norm of the residual YT - XT @ M.T, without forming the residual."""
+
+        return self.YTY - 2 * np.dot(self.YXT(XT).ravel(), M.ravel()) + np.dot(self.XXT(XT).ravel(), self.MTM(M).ravel())
+
+    def __getstate__(self):
+        # Cached products are cheap to rebuild relative to pickling them alongside YT
+        state = self.__dict__.copy()
+        for key in ('_XT', '_YXT', '_XXT', '_M', '_YTM', '_MTM'):
+            state[key] = None
+
+        return state
@@ -1,7 +1,11 @@
 import os, time, pickle, sys, psutil, resource, datetime, h5py, logging
 from collections import Iterable
+from pathlib import Path
 
 import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+from scipy.special import loggamma
 import torch
 import networkx as nx
 
@@ -69,7 +73,9 @@ def save_dict_to_hdf5_group(h5file, path, dic):
     permitted_dtypes = (np.ndarray, np.int64, np.float64, list, bool, float, int, str, bytes)
     for key, item in sorted(dic.items()):
         full_path = path + str(key)
-        if isinstance(item, permitted_dtypes):
+        if scipy.sparse.issparse(item):
+            save_sparse_hdf5_group(h5file, full_path, item)
+        elif isinstance(item, permitted_dtypes):
             if full_path in h5file:
                 h5file[full_path][...] = item
             else:
@@ -79,6 +85,86 @@ def save_dict_to_hdf5_group(h5file, path, dic):
         else:
             raise ValueError('Cannot save %s type'%type(item))
 
+def save_sparse_hdf5_group(h5file, path, matrix):
+    """Store a scipy.sparse matrix as an AnnData-style CSR group of data, indices and indptr datasets.
+
+    The group is written under a temporary name and then moved to path with :func:`replace_hdf5_object`, so an
+    existing matrix at path is kept until its replacement is complete.
+    """
+
+    matrix = matrix.tocsr()
+    staging_path = get_staging_path(path)
+    if staging_path in h5file:
+        del h5file[staging_path]
+
+    group = h5file.create_group(staging_path)
+    group.attrs['encoding-type'] = 'csr_matrix'
+    group.attrs['shape'] = matrix.shape
+    for key in ('data', 'indices', 'indptr'):
+        group[key] = getattr(matrix, key)
+
+    replace_hdf5_object(h5file, staging_path, path)
+    remove_staging(h5file)
+
+def get_staging_path(path, kind='new'):
+    """Temporary location of an object at path while it is written ('new') or replaced ('old')."""
+
+    return f'staging/{kind}/{path.strip("/")}'
+
+def replace_hdf5_object(h5file, source, path):
+    """Move the object at source to path, replacing the object at path, if any.
+
+    HDF5 cannot swap two objects at once, so the previous object is first moved aside, and only deleted once the new
+    one is in place. The path being replaced is recorded in the replacing attribute of the file until then, and
+    :func:`recover_hdf5_replacement` puts the previous object back if the replacement was interrupted in between.
+    """
+
+    if path not in h5file:
+        h5file.move(source, path)
+        return
+
+    backup_path = get_staging_path(path, kind='old')
+    if backup_path in h5file:
+        del h5file[backup_path]
+
+    h5file.attrs['replacing'] = path
+    h5file.move(path, backup_path)
+    h5file.move(source, path)
+    del h5file.attrs['replacing']
+    del h5file[backup_path]
+
+def recover_hdf5_replacement(h5file):
+    """Undo a :func:`replace_hdf5_object` that was interrupted, and remove the leftover temporary objects."""
+
+    path = h5file.attrs.get('replacing')
+    if path is not None:
+        backup_path = get_staging_path(path, kind='old')
+        if path not in h5file and backup_path in h5file:
+            h5file.move(backup_path, path)
+        del h5file.attrs['replacing']
+
+    remove_staging(h5file)
+
+def remove_staging(h5file):
+    """Delete the temporary objects, and the groups that held them (see :func:`get_staging_path`)."""
+
+    if 'staging' in h5file:
+        del h5file['staging']
+
+def load_sparse_hdf5_group(group):
+    """Read a CSR or CSC matrix stored as an AnnData-style group of data, indices and indptr datasets."""
+
+    shape = tuple(group.attrs['shape'] if 'shape' in group.attrs else group.attrs['h5sparse_shape'])
+    encoding = group.attrs.get('encoding-type', group.attrs.get('h5sparse_format', 'csr'))
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    matrix_type = scipy.sparse.csc_matrix if encoding.startswith('csc') else scipy.sparse.csr_matrix
+
+    return matrix_type((group['data'][()], group['indices'][()], group['indptr'][()]), shape=shape).tocsr()
+
+def is_sparse_hdf5_group(item):
+    return isinstance(item, h5py.Group) and ('encoding-type' in item.attrs or 'h5sparse_format' in item.attrs)
+
 def dict_to_list(dictionary):
     output = []
     dictionary_with_integer_keys = {int(k) : v for k, v in dictionary.items()}
@@ -114,10 +200,174 @@ def load_dict_from_hdf5_group(h5file, path):
     for key, item in sorted(h5file[path].items()):
         if isinstance(item, h5py._hl.dataset.Dataset):
             ans[key] = item.value
+        elif is_sparse_hdf5_group(item):
+            ans[key] = load_sparse_hdf5_group(item)
         elif isinstance(item, h5py._hl.group.Group):
             ans[key] = load_dict_from_hdf5_group(h5file, path + key + '/')
     return ans
 
+def load_history(h5file, path):
+    """Read a quantity recorded over iterations, e.g. weights/0 or progress/Q, from a result file.
+
+    Supports both the extendable datasets written by :class:`checkpoint.CheckpointWriter` and the legacy layout of
+    one dataset per iteration, named after the iteration. Checkpoints after the committed_iteration attribute of the
+    file were not committed, and are skipped.
+
+    Returns:
+        Array of the iterations of the checkpoints, in increasing order, and list of the values at those iterations.
+    """
+
+    item = h5file[path]
+    if isinstance(item, h5py.Group):
+        iterations = np.array(sorted(map(int, item.keys())), dtype=np.int64)
+    else:
+        iterations_path = 'iterations/' + item.name.strip('/')
+        if iterations_path in item.file:
+            iterations = item.file[iterations_path][()]
+        else:
+            iterations = np.arange(len(item))
+
+    committed_iteration = item.file.attrs.get('committed_iteration')
+    if committed_iteration is not None:
+        iterations = iterations[:np.searchsorted(iterations, committed_iteration, side='right')]
+
+    if isinstance(item, h5py.Group):
+        return iterations, [item[str(iteration)][()] for iteration in iterations]
+
+    return iterations, list(item[:len(iterations)])
+
+def greedy_coloring(adjacency):
+    """Color the nodes of a neighborhood graph so that no two neighbors share a color.
+
+    Uses the largest-first greedy strategy, which needs at most (max degree + 1) colors.
+
+    Args:
+        adjacency: neighborhood graph (see :class:`adjacency.Adjacency`)
+
+    Returns:
+        Array of integer colors, one per node.
+    """
+
+    graph = nx.from_scipy_sparse_array(adjacency.matrix)
+    coloring = nx.greedy_color(graph, strategy='largest_first')
+
+    return np.fromiter((coloring[node] for node in range(len(adjacency))), dtype=int, count=len(adjacency))
+
+def partition_graph(adjacency, num_partitions):
+    """Split the nodes of a neighborhood graph into balanced, spatially contiguous partitions.
+
+    Nodes are ordered by breadth-first search over each connected component, which keeps neighbors close together in
+    the ordering, and the ordering is then cut into num_partitions pieces of equal size.
+
+    Args:
+        adjacency: neighborhood graph (see :class:`adjacency.Adjacency`)
+        num_partitions: number of partitions
+
+    Returns:
+        Array of integer partition labels, one per node.
+    """
+
+    num_nodes = len(adjacency)
+    _, component_labels = scipy.sparse.csgraph.connected_components(adjacency.matrix, directed=False)
+    _, roots = np.unique(component_labels, return_index=True)
+    order = np.concatenate([
+        scipy.sparse.csgraph.breadth_first_order(adjacency.matrix, root, directed=False, return_predecessors=False)
+        for root in roots
+    ])
+
+    partitions = np.empty(num_nodes, dtype=int)
+    partitions[order] = np.arange(num_nodes) * num_partitions // max(num_nodes, 1)
+
+    return partitions
+
+# Arrays opened by load_shared_array, cached for the lifetime of the (worker) process
+_shared_arrays = {}
+
+def share_array(array, directory, name):
+    """Write an array to a .npy file so that worker processes can memory-map it instead of receiving a copy.
+
+    Args:
+        array: array to share
+        directory: directory in which to store the file
+        name: file name (without extension), unique within directory
+
+    Returns:
+        Path to the .npy file, which is a cheap-to-pickle handle for :func:`load_shared_array`.
+    """
+
+    # Arrays that are already memory-mapped from a .npy file are shared in place
+    if isinstance(array, np.memmap) and array.filename is not None and str(array.filename).endswith('.npy'):
+        return str(array.filename)
+
+    path = str(Path(directory) / f'{name}.npy')
+    np.save(path, np.ascontiguousarray(array))
+
+    return path
+
+def load_shared_array(path):
+    """Memory-map an array written by :func:`share_array`, reusing the mapping on later calls in the same process."""
+
+    if path not in _shared_arrays:
+        _shared_arrays[path] = np.load(path, mmap_mode='r')
+
+    return _shared_arrays[path]
+
+def share_expression(YT, directory, name):
+    """Share an expression matrix with :func:`share_array`, one array per component if YT is a scipy.sparse matrix.
+
+    Returns:
+        The path to the shared array, or a tuple of the paths to the shared data, indices and indptr arrays and the
+        shape of the CSR matrix, to pass to :func:`load_shared_expression`.
+    """
+
+    if not scipy.sparse.issparse(YT):
+        return share_array(YT, directory, name)
+
+    YT = YT.tocsr()
+    paths = tuple(share_array(getattr(YT, key), directory, f'{name}_{key}') for key in ('data', 'indices', 'indptr'))
+
+    return (*paths, YT.shape)
+
+def load_shared_expression(handle):
+    """Open an expression matrix shared by :func:`share_expression`, without copying it."""
+
+    if isinstance(handle, str):
+        return load_shared_array(handle)
+
+    data_path, indices_path, indptr_path, shape = handle
+    data, indices, indptr = map(load_shared_array, (data_path, indices_path, indptr_path))
+
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+# Coefficient tables of the series in the integrals over the simplex, keyed by (name, dtype, device, n)
+_coefficient_tables = {}
+
+def get_coefficient_table(name, n=2**14, dtype=torch.double, device='cpu'):
+    """Tensor of series coefficients, built on first use and shared across iterations and replicates.
+
+    Args:
+        name: 'log_gamma' for log Γ(1), ..., log Γ(n-1), or 'arange' for 0, ..., n-1
+        n: size of the table
+        dtype: PyTorch dtype of the table
+        device: PyTorch device of the table
+
+    Returns:
+        The cached tensor, which must not be modified in place.
+    """
+
+    key = (name, dtype, str(torch.device(device)), n)
+    if key not in _coefficient_tables:
+        if name == 'log_gamma':
+            table = loggamma(np.arange(1, n))
+        elif name == 'arange':
+            table = np.arange(n)
+        else:
+            raise NotImplementedError
+
+        _coefficient_tables[key] = torch.tensor(table, dtype=dtype, device=device)
+
+    return _coefficient_tables[key]
+
 def moran_i_statistic(gene_expression, coordinates, k=5):
     """Calculates per gene/metagene Moran's I statistic.
     